@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Scheduling of scope transactions across drives
+#
+# A drive is not checked until its sampling period should be complete, and the drive that is
+# due first is always served first. While one drive samples, the serial line is used for the
+# readout of the others, so several drives sharing one multi-drop RS-485 line keep the line busy
+# rather than waiting on each other. Drives on separate ports are served the same way.
+#
+# Alarm and parameter polls are background transactions, queued per port. They are run only
+# while every drive is still sampling, and only if they are expected to finish before the
+# first drive is due, so they cost no scope throughput. On a saturated line, e.g. three drives
+# on one multi-drop line need ~321 ms of readout every 200 ms, there is no such idle time, so an
+# alarm poll queued for alarm_max_age is run anyway, at the cost of a longer gap for the next
+# drive. Polls skipped and forced are counted per axis, see poll_report().
+#
+# Coverage
+#
+# Each block of 200 samples covers the scope duration, and is followed by a blind gap while the
+# drive waits to be checked and the samples are read out, ~130 ms. The gap before each block and
+# the fraction of time sampled, over the last window_sec and since the start, are kept per axis.
+
+
+import collections
+import time
+
+from leadshine_easyservo import *
+
+
+class Coverage:
+    def __init__(self, window_sec=10.):
+        self.window_sec = window_sec
+
+        # start of the first block and end of the sampling of the last block
+        self.t_first = None
+        self.t_end = None
+        # blind time before the last block, in seconds
+        self.gap = 0.
+        self.max_gap = 0.
+
+        self.sampled = 0.
+        # (start, duration) of the blocks within window_sec, and their total duration
+        self.blocks = collections.deque()
+        self.window_sampled = 0.
+
+
+    def add(self, t_start, duration):
+        # account for a block sampled for duration seconds from t_start, returns the gap before it
+        if self.t_end is None:
+            self.t_first = t_start
+            self.gap = 0.
+        else:
+            self.gap = max(0., t_start - self.t_end)
+            self.max_gap = max(self.max_gap, self.gap)
+        self.t_end = t_start + duration
+
+        self.sampled += duration
+        self.blocks.append((t_start, duration))
+        self.window_sampled += duration
+        while self.blocks[0][0] < self.t_end - self.window_sec:
+            self.window_sampled -= self.blocks.popleft()[1]
+
+        return self.gap
+
+
+    def ratio(self):
+        # sampled time / wall time since the first block
+        if self.t_end is None:
+            return 0.
+        return self.sampled / (self.t_end - self.t_first)
+
+
+    def rolling(self):
+        # sampled time / wall time over the last window_sec
+        if not self.blocks:
+            return 0.
+        return self.window_sampled / (self.t_end - self.blocks[0][0])
+
+
+    def __repr__(self):
+        return 'coverage {0:.0f}% ({1:.0f}% all-time), gap {2:.0f} ms'.format(self.rolling() * 100., self.ratio() * 100., self.gap * 1000.)
+
+
+class Acquisition:
+    def __init__(self, drives, check_interval=.01, alarm_interval=1., parameter_interval=None, alarm_max_age=1.):
+        # drives maps names to drives, each already configured with scope_setup()
+        self.drives = drives
+        # delay before checking again a drive that was not yet complete
+        self.check_interval = check_interval
+        # name -> time at which the sampling of the drive is expected to be complete
+        self.due = {}
+        # name -> Coverage
+        self.coverage = dict((k, Coverage()) for k in drives)
+
+        # seconds between background polls of each drive, None to disable
+        self.alarm_interval = alarm_interval
+        self.parameter_interval = parameter_interval
+        # seconds an alarm poll may wait for idle time before it is run regardless, None to wait indefinitely
+        self.alarm_max_age = alarm_max_age
+
+        # transaction queues of the serial ports in use, drives on a multi-drop line share one
+        self.queues = []
+        for k, es in sorted(drives.items()):
+            if es.queue not in self.queues:
+                self.queues += [es.queue]
+
+
+    def start(self):
+        for k, es in sorted(self.drives.items()):
+            if self.alarm_interval is not None:
+                es.queue.every(self.alarm_interval, (k, 'alarms'), es.poll_alarms, priority_alarm, self.alarm_max_age)
+            if self.parameter_interval is not None:
+                es.queue.every(self.parameter_interval, (k, 'parameters'), es.poll_parameters, priority_poll)
+
+        for k, es in sorted(self.drives.items()):
+            es.scope_exec('begin')
+            self.due[k] = es.rt_s + es.scope_duration
+
+
+    def poll_report(self, k):
+        # background polls of axis k skipped and forced so far, shown next to its coverage
+        queue = self.drives[k].queue
+        rv = []
+        for poll in ['alarms', 'parameters']:
+            missed = queue.missed.get((k, poll), 0)
+            forced = queue.forced.get((k, poll), 0)
+            if missed or forced:
+                rv += ['{0} polls missed {1} forced {2}'.format(poll, missed, forced)]
+        return ', '.join(rv)
+
+
+    def next_block(self):
+        # wait for the next block from any drive, returns the name of the drive, the error, and the sample times
+        # the drive has already begun its next sampling period when this returns
+        while True:
+            k = min(self.due, key=self.due.get)
+
+            # use the line while all drives sample
+            for queue in self.queues:
+                queue.run_idle(self.due[k])
+
+            dt = self.due[k] - time.time()
+            if dt > 0:
+                time.sleep(dt)
+
+            es = self.drives[k]
+            error, error_x = es.scope_exec('retrieve')
+            if error != []:
+                # sampling began with the request, rt_s, and lasted scope_duration
+                self.coverage[k].add(es.rt_s, es.scope_duration)
+
+                # start next request while finishing up with the latest data
+                es.scope_exec('begin')
+                self.due[k] = es.rt_s + es.scope_duration
+                return k, error, error_x
+
+            self.due[k] = time.time() + self.check_interval
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Compressed archive of the following-error, for retention over weeks
+#
+# The raw files of leadshine_record are exported to an archive of chunks, each of chunk_blocks blocks.
+# A chunk holds two columns, compressed separately with zlib:
+#   times    the start and end time of each block, float64
+#   counts   the error of every sample in encoder counts, int16, as differences from the previous sample
+# The differences wrap around in int16, so the counts are recovered exactly. Following-error changes
+# slowly between samples, so the differences are small and compress well.
+#
+# An index holds the time range, min and max counts, and the location of each chunk, so a query reads
+# the index alone to find the chunks it needs, and only those are decompressed. Chunks are compressed
+# in a thread pool, zlib releases the gil while compressing. Exports are incremental, each export
+# appends the blocks recorded since the last.
+#
+# Files, for a prefix and axis:
+#   prefix.axis.arc       chunks, one after another
+#   prefix.axis.arcidx    chunk_dtype records, one per chunk
+#   prefix.axis.arcmeta   json, the samples per block and the scale of a count in mm
+#
+# The scale is that of the drive, saved with the recording by leadshine_record. An error that is not
+# a whole number of counts at that scale, or is beyond the range of int16, cannot be stored exactly,
+# and stops the export rather than being rounded or clipped.
+
+
+import os
+import sys
+import json
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from leadshine_record import Recording, raw_dtype
+
+
+chunk_dtype = np.dtype([('t0', '<f8'), ('t1', '<f8'), ('min', '<i2'), ('max', '<i2'), ('n_blocks', '<u4'),
+                        ('offset', '<u8'), ('times_len', '<u4'), ('counts_len', '<u4')])
+
+# 300 blocks of 200 ms is a minute of samples
+chunk_blocks = 300
+compression_level = 6
+n_threads = 4
+
+# largest difference, in counts, between an error and a whole number of counts, the error is recorded as float32
+count_tolerance = .01
+
+
+def encode(t, error, step_scale):
+    # a chunk from the block times, (blocks, 2), and errors in mm, (blocks, ns), as compressed columns and its min and max counts
+    x = np.asarray(error, dtype=np.float64).ravel() / step_scale
+    counts = np.rint(x)
+    if len(counts) and (counts.min() < -32768 or counts.max() > 32767):
+        raise ValueError('encode(): counts from {0:.0f} to {1:.0f} beyond int16'.format(counts.min(), counts.max()))
+    if len(counts) and np.abs(x - counts).max() > count_tolerance:
+        raise ValueError('encode(): error is not a whole number of counts of {0} mm, off by up to {1:.3f} counts'.format(
+            step_scale, np.abs(x - counts).max()))
+    counts = counts.astype('<i2')
+    delta = np.empty_like(counts)
+    delta[0] = counts[0]
+    np.subtract(counts[1:], counts[:-1], out=delta[1:])
+
+    times = zlib.compress(np.ascontiguousarray(t, dtype='<f8').tobytes(), compression_level)
+    return times, zlib.compress(delta.tobytes(), compression_level), counts.min(), counts.max()
+
+
+def decode(times, counts, ns):
+    # block times, (blocks, 2), and counts, (blocks, ns), of a chunk
+    t = np.frombuffer(zlib.decompress(times), dtype='<f8').reshape(-1, 2)
+    delta = np.frombuffer(zlib.decompress(counts), dtype='<i2')
+    return t, np.cumsum(delta, dtype=np.int16).reshape(-1, ns)
+
+
+class Archive:
+    def __init__(self, prefix, axis):
+        self.prefix = prefix
+        self.axis = axis
+
+        # set by the first export, from the recording
+        self.ns = None
+        self.step_scale = None
+        if os.path.exists(self.fn('arcmeta')):
+            with open(self.fn('arcmeta')) as f:
+                meta = json.load(f)
+            self.ns = meta['ns']
+            self.step_scale = meta['step_scale']
+
+
+    def fn(self, ext):
+        return '{0}.{1}.{2}'.format(self.prefix, self.axis, ext)
+
+
+    def index(self):
+        fn = self.fn('arcidx')
+        if not os.path.exists(fn):
+            return np.zeros(0, dtype=chunk_dtype)
+        return np.fromfile(fn, dtype=chunk_dtype)
+
+
+    def export(self, recording, step_scale=None, threads=n_threads):
+        # append the blocks of recording, a leadshine_record.Recording, recorded after the last chunk
+        # step_scale is that saved with the recording, and is needed only for recordings made without it
+        # returns the number of blocks exported
+        if step_scale is None:
+            step_scale = recording.step_scale
+        if step_scale is None:
+            raise ValueError('export(): {0} {1} has no step_scale, give the mm per count of the drive'.format(recording.prefix, recording.axis))
+
+        idx = self.index()
+        if len(idx) == 0:
+            self.ns = recording.ns
+            self.step_scale = step_scale
+            with open(self.fn('arcmeta'), 'w') as f:
+                json.dump({'ns': self.ns, 'step_scale': self.step_scale, 'codec': 'zlib'}, f)
+        elif (self.ns, self.step_scale) != (recording.ns, step_scale):
+            raise ValueError('export(): archive of {0} samples at {1} mm, recording of {2} at {3} mm'.format(
+                self.ns, self.step_scale, recording.ns, step_scale))
+
+        r = recording.open('raw', raw_dtype(self.ns))
+        first = np.searchsorted(r['t_start'], idx['t1'][-1], 'right') if len(idx) else 0
+        starts = range(first, len(r), chunk_blocks)
+
+        def compress(i):
+            block = r[i:i + chunk_blocks]
+            t = np.column_stack((block['t_start'], block['t_end']))
+            return (i, len(block)) + encode(t, block['error'], self.step_scale)
+
+        pool = ThreadPool(threads)
+        try:
+            with open(self.fn('arc'), 'ab') as f_arc, open(self.fn('arcidx'), 'ab') as f_idx:
+                rec = np.zeros(1, dtype=chunk_dtype)
+                for i, n, times, counts, lo, hi in pool.imap(compress, starts):
+                    rec['t0'] = r['t_start'][i]
+                    rec['t1'] = r['t_end'][i + n - 1]
+                    rec['min'] = lo
+                    rec['max'] = hi
+                    rec['n_blocks'] = n
+                    rec['offset'] = f_arc.tell()
+                    rec['times_len'] = len(times)
+                    rec['counts_len'] = len(counts)
+                    f_arc.write(times)
+                    f_arc.write(counts)
+                    # the index follows the chunks, so an interrupted export leaves no entry without its chunk
+                    f_arc.flush()
+                    rec.tofile(f_idx)
+        finally:
+            pool.close()
+
+        return len(r) - first
+
+
+    def chunks(self, t0, t1, level=None):
+        # index entries of the chunks overlapping [t0, t1], and, given level, with a count beyond +/- level
+        idx = self.index()
+        idx = idx[np.searchsorted(idx['t1'], t0, 'left'):np.searchsorted(idx['t0'], t1, 'right')]
+        if level is not None:
+            idx = idx[(idx['max'] > level) | (idx['min'] < -level)]
+        return idx
+
+
+    def read(self, t0, t1, level=None):
+        # the sample times and errors in mm within [t0, t1], only from the chunks selected by chunks()
+        idx = self.chunks(t0, t1, level)
+        if len(idx) == 0:
+            return np.zeros(0), np.zeros(0)
+
+        ts = []
+        es = []
+        with open(self.fn('arc'), 'rb') as f:
+            for c in idx:
+                f.seek(c['offset'])
+                t, counts = decode(f.read(c['times_len']), f.read(c['counts_len']), self.ns)
+                ts += [t[:, :1] + (t[:, 1:] - t[:, :1]) * (np.arange(self.ns) / (self.ns - 1.))]
+                es += [counts]
+
+        t = np.concatenate(ts).ravel()
+        e = np.concatenate(es).ravel() * self.step_scale
+        keep = (t >= t0) & (t <= t1)
+        return t[keep], e[keep]
+
+
+    def summary(self):
+        idx = self.index()
+        if len(idx) == 0:
+            return 'empty archive'
+        n = idx['n_blocks'].sum()
+        stored = (idx['times_len'].astype(np.int64) + idx['counts_len']).sum()
+        raw = n * raw_dtype(self.ns).itemsize
+        return '{0} chunks {1} blocks {2:.1f} h, {3:.1f} MB from {4:.1f} MB, {5:.1f}x, counts {6} to {7}'.format(
+            len(idx), n, (idx['t1'][-1] - idx['t0'][0]) / 3600., stored / 1e6, raw / 1e6, raw / float(max(stored, 1)),
+            idx['min'].min(), idx['max'].max())
+
+
+def main():
+    if len(sys.argv) < 4 or sys.argv[1] not in ('export', 'info'):
+        print 'usage:', sys.argv[0], 'export recording_prefix archive_prefix axis...'
+        print '      ', sys.argv[0], 'info archive_prefix axis...'
+        sys.exit(1)
+
+    if sys.argv[1] == 'info':
+        for axis in sys.argv[3:]:
+            print axis, Archive(sys.argv[2], axis).summary()
+        return
+
+    for axis in sys.argv[4:]:
+        st = time.time()
+        arc = Archive(sys.argv[3], axis)
+        try:
+            n = arc.export(Recording(sys.argv[2], axis))
+        except ValueError as e:
+            print axis, e
+            sys.exit(1)
+        print axis, n, 'blocks exported in {0:.1f} s,'.format(time.time() - st), arc.summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Combined following-error of several axes
+#
+# The axes are sampled by independent drives, each block at its own times, so the error of each
+# axis is interpolated onto a common grid of times. The grid advances as blocks arrive, up to the
+# latest time for which every axis has been sampled, and only the samples needed for the next grid
+# point are kept. Grid points that fall in the readout gap of any axis are nan.
+#
+# The magnitude of the error vector is exact. The contour error, the deviation from the path, needs
+# the direction of the path, which the drives do not report. During motion the following-error is
+# dominated by the lag along the direction of travel, so the low-passed error vector is used as the
+# direction, and the contour error is the part of the error perpendicular to it. While the lag is
+# below min_lag the machine is taken to be at rest, and the contour error is the magnitude.
+
+
+import collections
+
+import numpy as np
+
+from leadshine_filter import LowPass
+
+
+class Contour:
+    def __init__(self, axes, dt=.001, max_gap=None, lag_cutoff=2., min_lag=.005, window_sec=5.):
+        # axes are the names of the axes combined, dt the spacing of the grid, typically the sample period
+        self.axes = list(axes)
+        self.dt = dt
+        # samples further apart than max_gap seconds are not interpolated between
+        self.max_gap = max_gap if max_gap is not None else 2.5 * dt
+        self.min_lag = min_lag
+        self.window_sec = window_sec
+
+        # samples of each axis not yet passed by the grid
+        self.t = dict((k, np.zeros(0)) for k in self.axes)
+        self.e = dict((k, np.zeros(0)) for k in self.axes)
+        # next time of the grid, set once every axis has data
+        self.t_next = None
+
+        self.lag = [LowPass(lag_cutoff, dt) for k in self.axes]
+
+        # (grid, magnitude, contour) within the last window_sec
+        self.history = collections.deque()
+
+
+    def add_block(self, k, error, error_x):
+        # returns (grid, error (n, axes), magnitude, contour) for the new grid points, or None
+        if k not in self.t:
+            return None
+        self.t[k] = np.concatenate((self.t[k], error_x))
+        self.e[k] = np.concatenate((self.e[k], error))
+
+        if any(len(self.t[a]) == 0 for a in self.axes):
+            return None
+        if self.t_next is None:
+            self.t_next = max(self.t[a][0] for a in self.axes)
+        t_ready = min(self.t[a][-1] for a in self.axes)
+        if t_ready < self.t_next:
+            return None
+
+        n = int((t_ready - self.t_next) / self.dt) + 1
+        grid = self.t_next + self.dt * np.arange(n)
+        self.t_next = grid[-1] + self.dt
+
+        err = np.empty((n, len(self.axes)))
+        for j, a in enumerate(self.axes):
+            t = self.t[a]
+            err[:, j] = np.interp(grid, t, self.e[a])
+            if len(t) > 1:
+                i = np.clip(np.searchsorted(t, grid), 1, len(t) - 1)
+                err[(t[i] - t[i - 1]) > self.max_gap, j] = np.nan
+
+            # keep the last sample before the next grid point, and those after it
+            i = max(np.searchsorted(t, self.t_next) - 1, 0)
+            self.t[a] = t[i:]
+            self.e[a] = self.e[a][i:]
+
+        magnitude = np.sqrt((err ** 2).sum(axis=1))
+
+        # the direction of travel from the lag, filtered over the grid points every axis sampled
+        contour = magnitude.copy()
+        valid = ~np.isnan(magnitude)
+        if valid.any():
+            ev = err[valid]
+            lag = np.column_stack([f.update(ev[:, j]) for j, f in enumerate(self.lag)])
+            lag_mag = np.sqrt((lag ** 2).sum(axis=1))
+            moving = lag_mag >= self.min_lag
+            along = (ev * lag).sum(axis=1) / np.where(moving, lag_mag, 1.)
+            c = np.sqrt(np.maximum(magnitude[valid] ** 2 - along ** 2, 0.))
+            contour[valid] = np.where(moving, c, magnitude[valid])
+
+        self.history.append((grid, magnitude, contour))
+        while self.history and self.history[0][0][-1] < grid[-1] - self.window_sec:
+            self.history.popleft()
+
+        return grid, err, magnitude, contour
+
+
+    def summary(self):
+        # rms and max of the contour error, and the fraction of the grid every axis sampled, over the last window_sec
+        if not self.history:
+            return np.nan, np.nan, 0.
+        c = np.concatenate([v[2] for v in self.history])
+        valid = ~np.isnan(c)
+        if not valid.any():
+            return np.nan, np.nan, 0.
+        return np.sqrt(np.mean(c[valid] ** 2)), c[valid].max(), valid.mean()
+
+
+    def __repr__(self):
+        rms, peak, coverage = self.summary()
+        return 'contour error rms {0:.4f} mm max {1:.4f} mm ({2:.0f}% of time on all axes)'.format(rms, peak, coverage * 100.)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Step response of the current loop
+#
+# The current test of each drive commands a step of current and records 200 samples of the current
+# measured, see LeadshineEasyServo.current_test(). Every axis is tested at the same time, a number
+# of runs for each setting of the current loop gains, and the responses of all axes and runs are
+# scored together as one array:
+#   rise time           10% to 90% of the step
+#   overshoot           peak above the commanded current, % of the step
+#   settling time       from 10% of the step until the response stays within settle_band of its final value
+#   steady-state error  commanded less the final value, the mean of the second half of the step
+# The drive releases the step before the end of the capture, the step is taken to end where the
+# response falls back below 75%. The runs of each axis and setting are averaged and appended to a table.
+#
+# The sample period of the current test is not known, times are in samples unless sample_period is set.
+
+
+import csv
+import os
+import sys
+import time
+
+import numpy as np
+
+from leadshine_easyservo import *
+
+
+serial_ports = {'x-axis': '/dev/ttyUSB0',
+                'y-axis': '/dev/ttyUSB1',
+                'z-axis': '/dev/ttyUSB2'}
+
+# (current loop kp, current loop ki) settings to test, None for the gains already in the drive
+current_settings = [None, (641, 291), (800, 291), (641, 400)]
+
+# commanded current, in the units of the response
+current_step = 0x200
+
+n_runs = 5
+
+# seconds per sample, None to report times in samples
+sample_period = None
+
+# within this fraction of the step of the final value is considered settled
+# the current is quantized to ~11 units, ~2% of the default step, and noisy to ~5%
+settle_band = .1
+
+results_fn = 'current_test.csv'
+
+# a response captured from ProTuner with the default gains and step, truncated to 171 samples by the
+# sniffer, run with 'example' to check step_metrics() without a drive
+example_response = [
+   32,  32,  43,  21,  21,  43,  32,  43,  32,  10,  32,  43, 208, 351, 439, 505, 516, 516, 505, 516,
+  516, 516, 527, 494, 516, 516, 527, 516, 527, 505, 505, 527, 505, 505, 527, 505, 505, 505, 516, 505,
+  516, 516, 516, 505, 505, 505, 505, 505, 505, 494, 494, 505, 505, 516, 494, 494, 505, 483, 494, 494,
+  494, 494, 494, 494, 494, 494, 494, 494, 494, 494, 505, 505, 494, 505, 494, 494, 483, 472, 483, 505,
+  494, 494, 494, 516, 494, 494, 483, 494, 472, 494, 505, 483, 505, 505, 505, 494, 494, 505, 505, 483,
+  505, 516, 516, 527, 505, 483, 505, 494, 505, 505, 505, 505, 516, 505, 505, 516, 538, 494, 505, 516,
+  516, 516, 494, 516, 505, 527, 494, 494, 494, 494, 527, 538, 538, 483, 505, 516, 516, 527, 516, 516,
+  516, 483, 505, 516, 329, 175,  76,  43,  32,  32,  21,  10,  10,  32,  32,  32,  21,  21,  32,  21,
+   32,  32,  65,  21,   0,  10,  21,  10,  10,  10,  10]
+
+
+def first_index(mask, start=None):
+    # index of the first True of each row of mask at or after start, len of the row if there is none
+    n = mask.shape[1]
+    if start is not None:
+        mask = mask & (np.arange(n) >= start[:, None])
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), n)
+
+
+def step_metrics(y, target, band=settle_band, n_pre=8):
+    # y is a (runs, samples) array of step responses to target, one run per row
+    # returns a dict of arrays, one value per run, times in samples, nan where the response never rose
+    y = np.asarray(y, dtype=np.float64)
+    target = np.broadcast_to(np.asarray(target, dtype=np.float64), (len(y),))
+    n = y.shape[1]
+    idx = np.arange(n)
+
+    # the response before the step is the baseline
+    base = np.median(y[:, :n_pre], axis=1)
+    amp = target - base
+    r = (y - base[:, None]) / amp[:, None]
+
+    t10 = first_index(r >= .1)
+    t90 = first_index(r >= .9)
+    end = first_index(r < .75, t90)
+    ok = t90 < n
+
+    step = (idx >= t10[:, None]) & (idx < end[:, None])
+    second_half = (idx >= ((t90 + end) // 2)[:, None]) & (idx < end[:, None])
+    final = np.where(second_half, y, 0.).sum(axis=1) / np.maximum(second_half.sum(axis=1), 1)
+    peak = np.where(step, y, -np.inf).max(axis=1)
+
+    # the last sample of the step outside the band, the response settles after it
+    outside = step & (np.abs(y - final[:, None]) > band * np.abs(amp)[:, None])
+    last_outside = np.where(outside, idx, t10[:, None] - 1).max(axis=1)
+
+    rv = {
+        'rise': (t90 - t10).astype(np.float64),
+        'overshoot': np.maximum(peak - target, 0.) / amp * 100.,
+        'settling': (last_outside + 1 - t10).astype(np.float64),
+        'steady-state error': target - final,
+    }
+    for k in rv:
+        rv[k][~ok] = np.nan
+    return rv
+
+
+metric_names = ['rise', 'overshoot', 'settling', 'steady-state error']
+
+
+class CurrentTestRunner:
+    fields = ['axis', 'current loop kp', 'current loop ki', 'step', 'runs'] + \
+             ['{0} {1}'.format(k, s) for k in metric_names for s in ['mean', 'std']] + ['time']
+
+    def __init__(self, drives, fn=results_fn):
+        self.drives = drives
+        self.fn = fn
+
+
+    def run_setting(self, setting, step=current_step, runs=n_runs):
+        # runs of the current test on all axes at once, returns axis -> dict of metric arrays, one value per run
+        kp, ki = setting if setting is not None else (None, None)
+
+        responses = dict((k, []) for k in self.drives)
+        for i in range(runs):
+            rv = for_each_drive(self.drives, lambda es: es.current_test(kp, ki, step))
+            for k, v in rv.items():
+                if v is None:
+                    print 'run_setting(): current test failed', k, setting
+                else:
+                    responses[k] += [v]
+
+        # score all axes and runs as one array
+        keys = [k for k in sorted(responses) for v in responses[k]]
+        if not keys:
+            return {}
+        y = np.vstack([v for k in sorted(responses) for v in responses[k]])
+        m = step_metrics(y, step)
+
+        keys = np.array(keys)
+        return dict((k, dict((name, m[name][keys == k]) for name in metric_names)) for k in sorted(responses) if responses[k])
+
+
+    def append(self, axis, gains, step, metrics):
+        new_file = not os.path.exists(self.fn)
+        row = {'axis': axis, 'current loop kp': gains[0], 'current loop ki': gains[1], 'step': step,
+               'runs': len(metrics['rise']), 'time': time.time()}
+        for k in metric_names:
+            row[k + ' mean'] = np.nanmean(metrics[k])
+            row[k + ' std'] = np.nanstd(metrics[k])
+        with open(self.fn, 'ab') as f:
+            w = csv.DictWriter(f, CurrentTestRunner.fields)
+            if new_file:
+                w.writeheader()
+            w.writerow(row)
+
+
+    def run(self, settings=current_settings, step=current_step, runs=n_runs):
+        original = dict((k, (es.parameters['current loop kp'], es.parameters['current loop ki'])) for k, es in self.drives.items())
+
+        unit = 'samples' if sample_period is None else 's'
+        scale = 1. if sample_period is None else sample_period
+
+        for setting in settings:
+            rv = self.run_setting(setting, step, runs)
+            for k in sorted(rv):
+                m = rv[k]
+                gains = setting if setting is not None else original[k]
+                print k, gains, 'rise: {0:.1f} {4} overshoot: {1:.1f}% settling: {2:.1f} {4} steady-state error: {3:.1f}'.format(
+                    np.nanmean(m['rise']) * scale, np.nanmean(m['overshoot']), np.nanmean(m['settling']) * scale,
+                    np.nanmean(m['steady-state error']), unit)
+                self.append(k, gains, step, m)
+
+        # leave the drives as they were found
+        for k, es in self.drives.items():
+            es.write_parameters({'current loop kp': original[k][0], 'current loop ki': original[k][1]}, verify=True)
+
+
+def main():
+    if sys.argv[1:] == ['example']:
+        m = step_metrics([example_response], current_step)
+        for k in metric_names:
+            print k, m[k][0]
+        return
+
+    ess = open_drives(serial_ports)
+
+    st = time.time()
+    CurrentTestRunner(ess).run()
+    print 'Current tests completed in {0:.1f} s'.format(time.time() - st)
+
+
+if __name__ == "__main__":
+    main()
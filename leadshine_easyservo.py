@@ -52,24 +52,225 @@
 
 
 import sys
+import heapq
+import collections
 import serial
+import threading
 import time
 
-import numpy as np # for linspace
+import numpy as np
 
 from timing import *
+from leadshine_registers import *
+from leadshine_metrics import Counter, Histogram
 
 
-t1 = timing() # request through response
-t2 = timing() # response only
-t3 = timing() # update to update
 t4 = timing() # graphing
 
 
+# link and acquisition health, see leadshine_metrics
+# port and slave label every series, so each series is only updated by the thread holding the port
+transactions = Counter('leadshine_transactions_total', 'Requests sent to the drive', ['port', 'slave', 'function'])
+crc_failures = Counter('leadshine_crc_failures_total', 'Responses with a bad crc', ['port', 'slave'])
+resyncs = Counter('leadshine_resyncs_total', 'Bytes discarded while looking for the start of a response', ['port', 'slave'])
+timeouts = Counter('leadshine_timeouts_total', 'Responses missing or shorter than expected', ['port', 'slave'])
+exceptions = Counter('leadshine_exceptions_total', 'Exception responses', ['port', 'slave'])
+wasted_checks = Counter('leadshine_scope_checks_wasted_total', 'Scope status checks made before the sampling was complete', ['port', 'slave'])
+blocks = Counter('leadshine_scope_blocks_total', 'Scope blocks read out', ['port', 'slave'])
+retries = Counter('leadshine_retries_total', 'Requests sent again after a timeout or bad crc', ['port', 'slave'])
+failures = Counter('leadshine_failures_total', 'Transactions abandoned after all retries', ['port', 'slave'])
+# time from the end of the request to the start of the response, less the time on the wire
+latency_seconds = Histogram('leadshine_latency_seconds', 'Response latency of the drive', ['port', 'slave'],
+                            [.0005, .001, .002, .003, .005, .0075, .01, .015, .02, .03, .05])
+# request: begin request through end request, i.e. sampling and waiting to be checked
+# readout: response to the end request, cycle: from one block to the next, graph: plotting a block
+# background polls, see TransactionQueue, labelled by the name of the poll, e.g. ('x-axis', 'alarms')
+polls_missed = Counter('leadshine_polls_missed_total', 'Periodic polls skipped as the previous one was still queued', ['axis', 'poll'])
+polls_forced = Counter('leadshine_polls_forced_total', 'Polls run past their max age, outside of idle time', ['axis', 'poll'])
+stage_seconds = Histogram('leadshine_stage_seconds', 'Duration of each stage of the scope cycle', ['port', 'slave', 'stage'])
+
+
+# requests that never change are compiled once, see leadshine_registers
+introduction_cmd = ['introduction', None, None, read_frame(0xFD)] # response ends with 0x82
+
+scope_setup_cmds = [
+  # the last word sets the duration in 10ms increments, i.e. 0x000a = 10 -> 10 * 10ms = 100ms
+  #['scope_setup1', None, None, write_frame(0xD0, 0x012C)], # 3000 ms sampling (~3097 ms total)
+  #['scope_setup1', None, None, write_frame(0xD0, 0x0064)], # 1000 ms sampling (~1119 ms total)
+  #['scope_setup1', None, None, write_frame(0xD0, 0x0028)], # 400 ms sampling (~527 ms total)
+  ['scope_setup1', None, None, write_frame(0xD0, 0x0014)], # 200 ms sampling (~328 ms total)
+  #['scope_setup1', None, None, write_frame(0xD0, 0x000a)], # 100 ms sampling (~230 ms total)
+  ['scope_setup2', None, None, write_frame(0x41, 0x0001)],
+  ['scope_setup3', None, None, write_frame(0x42, 0x0000)]
+]
+
+scope_cmds = [
+  ['scope_begin', None, None, write_frame(0x14, 0x01)], # begin
+  ['scope_check', None, None, read_frame(0xDA)],        # repeat until response[-1] == 0x02, waiting 100 millisec or so between
+  ['scope_end',   None, None, read_frame(0x14, 0xc8)]   # end
+]
+
+motion_profile = {
+  'acceleration (r/s/s)': 2000, # motion_test1
+  'trace time?':           100, # motion_test2
+  'intermission (ms)?':    100, # motion_test3
+  'distance?':               1, # motion_test4
+  'velocity (rpm)':         60  # motion_test5
+}
+
+motion_test_cmds = [
+  ['motion_test6',   None, None, write_frame(0xD0, 0x0064)], # identical to scope setup
+  ['motion_test7',   None, None, write_frame(0x41, 0x0001)], # identical to scope setup
+  ['motion_test8',   None, None, write_frame(0x42, 0x0000)], # identical to scope setup
+
+  ['motion_test9',   None, None, write_frame(0x09, 0x0001)]  # unique
+]
+
+# parameters that read_parameters() cannot do without, the scaling of the following-error depends on them
+required_parameters = ['position error limit (pulses)', 'pulses / revolution']
+
+# there are 200 samples regardless of sampling duration, each reading is a word
+scope_ns = 200
+
+current_test_start_cmds = [write_frame(0x41, 0x0008), write_frame(0x02, 0x0001)] # scope channel current, start
+current_test_read_cmd = read_frame(0x05, 0xc8)
+current_test_end_cmds = [write_frame(0x02, 0x0000), write_frame(0x41, 0x0001)]   # stop, scope channel position error
+
+
+# every transaction has a deadline of the time the request and response take on the wire, plus an allowance
+# for the latency of the drive, the usb serial adapter, and the os
+# the allowance is estimated for each drive from the measured latency, as the mean plus four deviations,
+# and is kept within latency_min and latency_max, so a lost byte stalls for tens of milliseconds, not seconds
+# the port is opened at baudrate, so the deadlines follow any change to it
+baudrate = 38400
+# 8N1, a start bit, eight data bits, and a stop bit for each byte
+byte_time = 10. / baudrate
+latency_initial = .02
+latency_min = .005
+latency_max = .05
+# a transaction that timed out or failed its crc is sent again up to max_retries times, exception responses are not
+max_retries = 2
+
+
+# serial port -> (serial, lock, transaction queue) of the ports opened so far
+shared_ports = {}
+shared_ports_lock = threading.Lock()
+
+
+# transaction priorities, lower is more urgent
+# scope begin and readout are critical and are never queued, they take the port lock directly
+# everything else waits in the port's queue for the idle time while the drives sample
+priority_critical = 0
+priority_alarm = 1
+priority_poll = 2
+
+
+def poll_labels(name):
+    # label values of polls_missed and polls_forced, names are (axis, poll) as queued by Acquisition
+    if isinstance(name, tuple) and len(name) == 2:
+        return (str(name[0]), str(name[1]))
+    return (str(name), '')
+
+
+class TransactionQueue:
+    def __init__(self, lock):
+        # lock is the lock of the serial port, held while a transaction runs
+        self.lock = lock
+
+        # heap of [priority, sequence, name, f, time submitted, max age], sequence keeps submission order within a priority
+        self.heap = []
+        self.seq = 0
+        self.heap_lock = threading.Lock()
+
+        # periodic transactions, [next time, interval, priority, name, f, max age]
+        self.periodic = []
+
+        # name -> periodic submissions skipped, and runs forced past the max age
+        self.missed = collections.defaultdict(int)
+        self.forced = collections.defaultdict(int)
+
+        # name -> duration in seconds of the last run, to judge if a transaction fits in the idle time
+        self.durations = {}
+        self.default_duration = .02
+
+
+    def submit(self, name, f, priority=priority_poll, max_age=None):
+        # queue f() to run in idle time, f performs its own transactions on the port
+        # once queued for max_age seconds, f() is run at the next run_idle() whether or not it fits, None waits for idle time
+        with self.heap_lock:
+            heapq.heappush(self.heap, [priority, self.seq, name, f, time.time(), max_age])
+            self.seq += 1
+
+
+    def every(self, interval, name, f, priority=priority_poll, max_age=None):
+        # submit f() every interval seconds, skipped while the previous submission is still queued
+        with self.heap_lock:
+            self.periodic += [[time.time(), interval, priority, name, f, max_age]]
+
+
+    def pending(self, name):
+        with self.heap_lock:
+            return any(v[2] == name for v in self.heap)
+
+
+    def run_idle(self, deadline):
+        # run queued transactions, most urgent first, as long as each is expected to finish before deadline
+        # critical transactions are run regardless of the deadline
+        # returns the number of transactions run
+        # transactions queued past their max age are run first, regardless of the deadline, so a saturated line
+        # delays them rather than starving them
+        ct = time.time()
+        for v in self.periodic:
+            if v[0] <= ct:
+                v[0] = ct + v[1]
+                if not self.pending(v[3]):
+                    self.submit(v[3], v[4], v[2], v[5])
+                else:
+                    self.missed[v[3]] += 1
+                    polls_missed.inc(poll_labels(v[3]))
+
+        n = 0
+        while True:
+            with self.heap_lock:
+                if not self.heap:
+                    break
+                ct = time.time()
+                overdue = [v for v in self.heap if v[5] is not None and ct - v[4] > v[5]]
+                if overdue:
+                    v = min(overdue)
+                    self.heap.remove(v)
+                    heapq.heapify(self.heap)
+                    self.forced[v[2]] += 1
+                    polls_forced.inc(poll_labels(v[2]))
+                else:
+                    v = self.heap[0]
+                    if v[0] > priority_critical and ct + self.durations.get(v[2], self.default_duration) > deadline:
+                        break
+                    heapq.heappop(self.heap)
+                priority, seq, name, f = v[:4]
+
+            with self.lock:
+                t = time.time()
+                f()
+                self.durations[name] = time.time() - t
+            n += 1
+
+        return n
+
+
+
 class LeadshineEasyServo:
 
-    def __init__(self):
+    def __init__(self, slave=slave_address):
         self.serial_port = None
+
+        # modbus slave address, drives on a multi-drop RS-485 line are told apart by their address
+        self.slave = slave
+        self.headers = [bytes(bytearray([slave, ct])) for ct in [fc_read, fc_write, fc_write_multiple]]
+        self.exception_headers = [bytes(bytearray([slave, fc_exception | ct])) for ct in [fc_read, fc_write, fc_write_multiple]]
+
+        # held for the duration of a transaction, shared by all drives on the same serial port
+        self.lock = threading.RLock()
         # scaling value to convert following error to millimeters
         # 4000 encoder pulses per revolution, and 5mm pitch ballscrew
         # updated after reading parameters
@@ -83,96 +284,214 @@ class LeadshineEasyServo:
         self.rt_s = 0
         self.rt_e = 0
 
+        # sampling duration in seconds of the scope, as configured by scope_setup() or motion_test()
+        self.scope_duration = .2
 
-    @staticmethod
-    def modbus_crc(dat):
-        crc = 0xffff
+        # whether the drive accepts function 0x10, write multiple registers
+        # None until the first attempt
+        self.write_multiple = None
 
-        for c in dat:
-            crc ^= c
+        # exception code of the last exception response, if any
+        self.last_exception = None
 
-            for i in range(8):
-                if (crc & 0x00001):
-                    crc >>= 1
-                    crc ^= 0xa001
-                else:
-                    crc >>= 1
+        # estimate of the response latency, mean and mean deviation, see latency_initial
+        self.latency = latency_initial
+        self.latency_dev = latency_initial / 2.
+
+        # label values of the metrics of this drive, set by open_serial(), and the time of the last block
+        self.labels = ('', str(slave))
+        self.t_block = None
 
-        crc = bytearray([0x00ff & crc, (0xff00 & crc) >> 8])
-        return crc
+        # last alarm word read by poll_alarms(), None until the first poll
+        self.alarm_word = None
+        # called with (drive, event) for each alarm event, event is (time, 'raised' or 'cleared', name)
+        self.on_alarm = None
 
+        # the scope readout is received into the same buffer every time, and decoded through a view of its payload
+        self.scope_buf = bytearray(3 + scope_ns * 2 + 2)
+        self.scope_steps = np.frombuffer(self.scope_buf, dtype='>i2', count=scope_ns, offset=3)
+        self.scope_error = np.zeros(scope_ns)
 
-    def check_crc(shelf, dat):
-        msg = dat[:-2]
-        crc1 = dat[-2:]
-        crc2 = LeadshineEasyServo.modbus_crc(msg)
-        if crc1 != crc2:
-            print 'failed crc', map(hex, crc1), map(hex, crc2)
-        return crc1 == crc2
 
+    modbus_crc = staticmethod(modbus_crc)
 
-    def check_header(shelf, dat): # ct = 0x03 or 0x06
+
+    def check_crc(shelf, dat, n=-1):
+        # dat is a bytearray holding a message of n bytes followed by its crc, checked in place
+        if n == -1:
+            n = len(dat) - 2
+        if not crc_matches(dat, n):
+            crc_failures.inc(shelf.labels)
+            print 'failed crc', map(hex, dat[n:n + 2]), map(hex, modbus_crc(dat[:n]))
+            return False
+        return True
+
+
+    def check_header(self, dat): # ct = 0x03, 0x06, or 0x10
         header = dat[:2]
-        known_headers = [bytearray([0x01, 0x03]), bytearray([0x01, 0x06])]
-        return header in known_headers
+        return header in self.headers
+
 
+    def response_timeout(self, request_len, response_len):
+        # seconds allowed for a request of request_len bytes, not yet on the wire, and its response
+        allowance = min(max(self.latency + 4. * self.latency_dev, latency_min), latency_max)
+        return (request_len + response_len) * byte_time + allowance
+
+
+    def observe_latency(self, elapsed, request_len, response_len):
+        # update the latency estimate from a transaction completed in elapsed seconds
+        latency = max(elapsed - (request_len + response_len) * byte_time, 0.)
+        latency_seconds.observe(latency, self.labels)
+        self.latency_dev += .25 * (abs(latency - self.latency) - self.latency_dev)
+        self.latency += .125 * (latency - self.latency)
+
+
+    def read_into(self, view, deadline):
+        # fill view, a memoryview, from the serial port, returns the number of bytes read before the deadline
+        n = 0
+        while n < len(view):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # setting the timeout reconfigures the port, a system call, so the timeout is only changed when it is far
+            # from the time remaining, a read then ends by 2x the time remaining
+            timeout = self.ser.timeout
+            if timeout is None or remaining < .5 * timeout or remaining > 2. * timeout:
+                self.ser.timeout = remaining
+            k = self.ser.readinto(view[n:])
+            if not k:
+                break
+            n += k
+        return n
+
+
+    def read_response_into(self, buf, expected_len, deadline):
+        # read a response of expected_len bytes into buf, a preallocated bytearray, and check its crc in place
+        # returns the number of payload bytes, found from buf[3], or None if it is not complete by deadline
+        view = memoryview(buf)
 
-    def read_response(self, expected_len=-1):
         # read using a sliding window to find the start
-        v = self.ser.read(1)
+        if self.read_into(view[0:2], deadline) != 2:
+            timeouts.inc(self.labels)
+            return None
         while True:
-            v += self.ser.read(1)
-            if len(v) < 2:
-                return None
-            if v in ['\x01\x03', '\x01\x06']:
+            if buf[0] == self.slave and buf[1] in (fc_read, fc_write, fc_write_multiple):
                 break
+            elif buf[0] == self.slave and (buf[1] ^ fc_exception) in (fc_read, fc_write, fc_write_multiple):
+                # exception response, the exception code and crc follow
+                if self.read_into(view[2:5], deadline) == 3 and self.check_crc(buf, 3):
+                    exceptions.inc(self.labels)
+                    self.last_exception = buf[2]
+                    print 'read_response_into(): exception', hex(buf[1]), buf[2]
+                return None
             else:
-                print 'read_response(): discarding:', hex(bytearray(v)[0])
-                v = v[1:]
-
-        # read length (number of bytes) and append to message
-        # this does not appear to actually be the length
-        n = self.ser.read(1)
-        if len(n) == 0:
-            print 'read_response(): zero length read'
+                print 'read_response_into(): discarding:', hex(buf[0])
+                resyncs.inc(self.labels)
+                buf[0] = buf[1]
+                if self.read_into(view[1:2], deadline) != 1:
+                    timeouts.inc(self.labels)
+                    return None
+
+        # read length (number of bytes), remainder of message, and checksum
+        # the length does not appear to actually be the length
+        n = self.read_into(view[2:expected_len], deadline)
+        if n != expected_len - 2:
+            timeouts.inc(self.labels)
+        if n == 0:
+            print 'read_response_into(): zero length read'
             return None
-        v += n
-        n = bytearray(n)
-        n = int(n[0])
-
-        # read remainder of message and checksum
-        v += self.ser.read(expected_len - len(v))
-        if expected_len != -1 and len(v) != expected_len:
-            print 'read_response(): n != expected_len', n, expected_len
+        if n != expected_len - 2:
+            print 'read_response_into(): n != expected_len', buf[2], expected_len
             return None
-        v = bytearray(v)
 
-        #print map(hex, v)
+        #print map(hex, buf[:expected_len])
 
-        if not self.check_header(v):
-            print 'read_response(): failed header', map(hex, v)
-            sys.exit(1)
-        if not self.check_crc(v):
-            print 'read_response(): failed crc', map(hex, v)
+        if not self.check_crc(buf, expected_len - 2):
+            print 'read_response_into(): failed crc', map(hex, buf[:expected_len])
+            return None
 
-        v = v[3:-2]
+        return expected_len - 5
+
+
+    def echoes(self, cmd, buf):
+        # whether buf holds the response to cmd, a write is answered with its address and value or count, so the
+        # late response to an earlier write is not taken for this one
+        if bytearray(cmd)[1] not in (fc_write, fc_write_multiple):
+            return True
+        if buf[:6] != bytearray(cmd)[:6]:
+            print 'transaction(): response', map(hex, buf[:6]), 'is not to', map(hex, bytearray(cmd)[:6])
+            return False
+        return True
+
+
+    def transaction(self, cmd, buf, expected_len):
+        # send cmd, a compiled request, and read its response of expected_len bytes into buf
+        # a response that is late, short, or fails its crc is requested again, see max_retries, except for a write
+        # that must not be repeated, see write_hazard(), which is sent once and then confirmed
+        # returns the number of payload bytes, or None
+        with self.lock:
+            if self.slave != slave_address:
+                cmd = readdress_frame(cmd, self.slave)
+            function = self.labels + (function_names.get(bytearray(cmd)[1], '?'),)
+            once, extra = write_hazard(cmd)
+
+            for attempt in range(1 if once else max_retries + 1):
+                if attempt:
+                    retries.inc(self.labels)
+                    # the late response, or the rest of a broken one, must not be taken as the response to the retry
+                    self.drain(quiet=.005, deadline=.02)
+
+                self.last_exception = None
+                ct = time.time()
+                n = self.ser.write(cmd)
+                transactions.inc(function)
+                if n != len(cmd):
+                    print 'transaction(): incomplete serial write', map(hex, bytearray(cmd))
+                    continue
 
-        return v
+                n = self.read_response_into(buf, expected_len, ct + self.response_timeout(len(cmd), expected_len) + extra)
+                if n is not None and self.echoes(cmd, buf):
+                    if not extra:
+                        # a slow write is not typical of the drive
+                        self.observe_latency(time.time() - ct, len(cmd), expected_len)
+                    return n
+                if self.last_exception is not None:
+                    # the drive answered, asking again will not change its answer
+                    return None
+
+            if once:
+                n = self.confirm_write(cmd, once, buf)
+                if n is not None:
+                    return n
+
+            failures.inc(self.labels)
+            return None
 
 
-    def send_introduction(self):
-        introduction = [0x01, 0x03, 0x00, 0xFD, 0x00, 0x01]
-        introduction = bytearray(introduction) # 0x15, 0xFA
-        introduction += LeadshineEasyServo.modbus_crc(introduction)
+    def confirm_write(self, cmd, regs, buf):
+        # whether a write of regs, not to be sent again, took effect, found by reading back the register once the line
+        # is quiet, returns as transaction() with the echo the drive would have sent in buf, or None
+        # the late response must not be taken as the response to the read
+        self.drain()
 
-        n = self.ser.write(introduction)
-        if n != len(introduction):
-            print 'send_introduction(): introduction was truncated'
-            sys.exit(1)
+        slave, ct, address, value = parse_frame(cmd)
+        if ct != fc_write or not regs[0].readback:
+            print 'confirm_write(): unable to confirm', regs[0].name, 'not sent again'
+            return None
 
-        response = self.read_response(7)
+        rbuf = bytearray(7)
+        if self.transaction(read_frame(address), rbuf, 7) is None or ((rbuf[3] << 8) | rbuf[4]) != value:
+            print 'confirm_write():', regs[0].name, 'did not take effect, not sent again'
+            return None
 
-        return response[-1] == 0x82
+        buf[:8] = bytearray(cmd)
+        return 3
+
+
+    def send_introduction(self):
+        response = self.run_cmd(introduction_cmd)
+
+        return response is not None and response[-1] == 0x82
 
 
     def run_cmd(self, cmd, do_read_response=True, expected_len=-1):
@@ -181,48 +500,55 @@ class LeadshineEasyServo:
             return None
 
         desc, default_v, rng, cmd = cmd
-        cmd = bytearray(cmd)
-        cmd += LeadshineEasyServo.modbus_crc(cmd)
+        if not isinstance(cmd, bytes):
+            # a request without crc, as found in older command tables
+            cmd = compile_frame(cmd)
+
+        return self.run_frame(cmd, do_read_response, expected_len)
+
+
+    def run_frame(self, cmd, do_read_response=True, expected_len=-1):
+        # cmd is a compiled request, including crc, and is readdressed if this drive is not the default slave
+        with self.lock:
+            if not do_read_response:
+                if self.slave != slave_address:
+                    cmd = readdress_frame(cmd, self.slave)
+                n = self.ser.write(cmd)
+                transactions.inc(self.labels + (function_names.get(bytearray(cmd)[1], '?'),))
+                if n != len(cmd):
+                    print 'run_cmd(): incomplete serial write', map(hex, bytearray(cmd))
+                return None
 
-        n = self.ser.write(cmd)
-        if n != len(cmd):
-            print 'run_cmd(): incomplete serial write', cmd
-            sys.exit(1)
+            slave, ct, address, count = parse_frame(cmd)
+            if expected_len == -1:
+                expected_len = expected_response_len(cmd)
+                if expected_len == -1:
+                    print 'run_cmd(): not sure what to do'
+                    sys.exit(1)
 
-        if not do_read_response:
-            return None
+            buf = bytearray(expected_len)
+            if self.transaction(cmd, buf, expected_len) is None:
+                print 'run_cmd(): empty_response'
+                return None
+            response = buf[3:-2]
 
-        if expected_len == -1:
-            ct = cmd[1]
             if ct == 0x03:
-                response = self.read_response(7)
-            elif ct == 0x06:
-                response = self.read_response(8)
-            else:
-                print 'run_cmd(): not sure what to do'
-                sys.exit(1)
-
-        if response == None:
-            print 'run_cmd(): empty_response'
-            return None
-
-        if ct == 0x03:
-            if len(response) != 2:
-                print 'run_cmd(): unexpected response1 len', response
+                if len(response) != 2 * count:
+                    print 'run_cmd(): unexpected response1 len', response
 
-            #d = response[0] << 8 | response[1]
-            #print desc, n, map(hex, response), hex(d), d
-        elif ct == 0x06:
-            #if len(response) != 4:
-            if len(response) != 3:
-                print 'run_cmd(): unexpected response2 len ', len(response), 'to', map(hex, cmd), map(hex, response)
-                return None
+                #d = response[0] << 8 | response[1]
+                #print desc, n, map(hex, response), hex(d), d
+            elif ct == 0x06 or ct == 0x10:
+                #if len(response) != 4:
+                if len(response) != 3:
+                    print 'run_cmd(): unexpected response2 len ', len(response), 'to', map(hex, bytearray(cmd)), map(hex, response)
+                    return None
 
-            #d1 = response[0] << 8 | response[1]
-            #d2 = response[2] << 8 | response[3]
-            #print desc, n, map(hex, response), hex(d1), d1, hex(d2), d2
+                #d1 = response[0] << 8 | response[1]
+                #d2 = response[2] << 8 | response[3]
+                #print desc, n, map(hex, response), hex(d1), d1, hex(d2), d2
 
-        return response
+            return response
 
 
     def run_cmds(self, cmds, print_response=False):
@@ -242,79 +568,162 @@ class LeadshineEasyServo:
         return rv
 
 
-    def read_parameters(self):
-        # combined commands seen on parameters, motor settings, and inputs/outputs screens
+    def read_registers(self, reads):
+        # reads is a list of (frame, registers) from compile_reads(), each frame reading a run of contiguous registers
+        rv = {}
 
-        cmds = [
-          ['current loop kp',                 641,   [0, 32766], [0x01, 0x03, 0x00, 0x00, 0x00, 0x01]],
-          ['current loop ki',                 291,   [0, 32766], [0x01, 0x03, 0x00, 0x01, 0x00, 0x01]],
-          ['pulses / revolution',            4000, [200, 51200], [0x01, 0x03, 0x00, 0x0E, 0x00, 0x01]],
-          ['encoder resolution (ppr)',       4000, [200, 51200], [0x01, 0x03, 0x00, 0x0F, 0x00, 0x01]],
-          ['position error limit (pulses)',  1000,   [0, 65535], [0x01, 0x03, 0x00, 0x12, 0x00, 0x01]],
-          ['position loop kp',               2000,   [0, 32767], [0x01, 0x03, 0x00, 0x06, 0x00, 0x01]],
-          ['position loop ki',                500,   [0, 32767], [0x01, 0x03, 0x00, 0x07, 0x00, 0x01]],
-          ['position loop kd',                200,   [0, 32767], [0x01, 0x03, 0x00, 0x08, 0x00, 0x01]],
-          ['position loop kvff',               30,   [0, 32767], [0x01, 0x03, 0x00, 0x0D, 0x00, 0x01]],
-          ['holding current (%)',              40,     [0, 100], [0x01, 0x03, 0x00, 0x50, 0x00, 0x01]],
-          ['open-loop current (%)',            50,     [0, 100], [0x01, 0x03, 0x00, 0x51, 0x00, 0x01]],
-          ['closed-loop current (%)',         100,     [0, 100], [0x01, 0x03, 0x00, 0x52, 0x00, 0x01]],
-          ['anti-interference time',         1000,    [0, 1000], [0x01, 0x03, 0x00, 0x53, 0x00, 0x01]],
-          ['enable control',                    1,       [0, 1], [0x01, 0x03, 0x00, 0x96, 0x00, 0x01]], # 0 = high level, 1 = low level
-          ['fault output',                      0,       [0, 1], [0x01, 0x03, 0x00, 0x97, 0x00, 0x01]], # 0 = active high, 1 = active low
-          ['filtering enable',                  0,       [0, 1], [0x01, 0x03, 0x00, 0x54, 0x00, 0x01]], # 0 = disabled, 1 = enabled
-          ['filtering time (us)',           25600,  [50, 25600], [0x01, 0x03, 0x00, 0x55, 0x00, 0x01]],
-          ['reserved (pulse mode)?',            0,       [0, 1], [0x01, 0x03, 0x00, 0x4F, 0x00, 0x01]], # reported value = 0
-          ['pulse active edge',                 4,       [4, 6], [0x01, 0x03, 0x00, 0xFF, 0x00, 0x01]], # 4 = rising, 6 = falling
-          ['reserved (direction)?',           130,       [0, 1], [0x01, 0x03, 0x00, 0xFD, 0x00, 0x01]], # reported value = 130
-          ['reserved (bandwidth)?',             1,       [0, 1], [0x01, 0x03, 0x00, 0x90, 0x00, 0x01]], # reported value = 1
-          ['current loop auto-configuration?',  1,       [0, 1], [0x01, 0x03, 0x00, 0x40, 0x00, 0x01]]
-        ]
+        for frame, regs in reads:
+            response = self.run_frame(frame)
+            if response is not None and len(response) == 2 * len(regs):
+                for i, r in enumerate(regs):
+                    rv[r.name] = r.decode(response, 2 * i)
+                continue
+
+            if len(regs) > 1:
+                print 'read_registers(): failed to read', [r.name for r in regs], 'together, reading one at a time'
+
+            # registers not read are left out of the result
+            for r in regs:
+                response = self.run_frame(r.read_frame)
+                if response is None or len(response) != 2:
+                    print 'read_registers(): failed to read', r.name
+                    continue
+                rv[r.name] = r.decode(response, 0)
+
+        return rv
+
+
+    def write_registers(self, address, values):
+        # write a run of contiguous registers with a single function 0x10 request
+        # returns False if the drive refused the request or did not respond
+        self.last_exception = None
+        response = self.run_frame(write_multiple_frame(address, values, self.slave))
+        if response is None:
+            if self.write_multiple is None or self.last_exception == 0x01:
+                # first attempt failed or illegal function, do not try again
+                self.write_multiple = False
+            return False
+
+        self.write_multiple = True
+        return True
+
+
+    def write_frames(self, frames):
+        # pipelined function 0x06 writes, all requests are sent before the responses are read
+        # writes without a good response are sent again one at a time, except writes that must not be repeated,
+        # see write_hazard(), which are confirmed instead
+        with self.lock:
+            if self.slave != slave_address:
+                frames = [readdress_frame(frame, self.slave) for frame in frames]
+            data = b''.join(frames)
+            # the drive answers all the requests once it has handled the slowest
+            extra = max(write_hazard(frame)[1] for frame in frames)
+            ct = time.time()
+            n = self.ser.write(data)
+            transactions.inc(self.labels + (function_names[fc_write],), len(frames))
+            if n != len(data):
+                print 'write_frames(): incomplete serial write'
+
+            failed = []
+            buf = bytearray(8)
+            for i, frame in enumerate(frames):
+                # the responses arrive one after another, following all the requests
+                deadline = ct + self.response_timeout(len(data), 8 * (i + 1)) + extra
+                if self.read_response_into(buf, 8, deadline) is None or not self.echoes(frame, buf):
+                    failed += [frame]
+
+            ok = True
+            if failed:
+                self.drain(quiet=.005, deadline=.02)
+            for frame in failed:
+                once = write_hazard(frame)[0]
+                if once:
+                    n = self.confirm_write(frame, once, buf)
+                else:
+                    n = self.transaction(frame, buf, 8)
+                if n is None:
+                    print 'write_frames(): no response to', map(hex, bytearray(frame))
+                    ok = False
+            return ok
+
+
+    def write_parameters(self, values, verify=False):
+        # write a set of named parameters, e.g. the position loop kp, ki, kd, and kvff together
+        # all values are checked against the register map before anything is written, raising ValueError
+        # contiguous registers are written with one function 0x10 request when the drive accepts it,
+        # otherwise with pipelined function 0x06 requests
+        runs = compile_writes(values)
+
+        ok = True
+        frames = []
+        for address, vals, regs in runs:
+            if len(vals) > 1 and self.write_multiple is not False:
+                if self.write_registers(address, vals):
+                    continue
+            # writes are idempotent, so a failed function 0x10 request is simply repeated register by register
+            frames += [write_frame(r.address, v) for r, v in zip(regs, vals)]
+
+        if frames:
+            ok = self.write_frames(frames) and ok
+
+        if verify:
+            # one coalesced read of everything just written
+            rv = self.read_registers(compile_reads(values.keys()))
+            for k, v in sorted(values.items()):
+                if rv.get(k) != v:
+                    print 'write_parameters(): verify failed', k, 'wrote', v, 'read', rv.get(k)
+                    ok = False
+
+        return ok
+
+
+    def read_parameters(self, verbose=True):
+        # combined registers seen on parameters, motor settings, and inputs/outputs screens
+        # contiguous registers are read together, reducing 22 requests to 10
+
+        rv = self.read_registers(parameter_reads)
+
+        missing = [k for k in required_parameters if k not in rv]
+        if missing:
+            raise IOError('read_parameters(): unable to read {0} from {1} slave {2}'.format(', '.join(missing), self.serial_port, self.slave))
 
-        rv = self.run_cmds(cmds, True)
+        self.parameters = rv
 
-        fe_max = rv['position error limit (pulses)']
+        self.fe_max = rv['position error limit (pulses)']
         ppr = rv['pulses / revolution']
-        step_scale = 1. / ppr * self.leadscrew_pitch
+        self.step_scale = 1. / ppr * self.leadscrew_pitch
+
+        if verbose:
+            self.print_parameters()
+
+        return rv
+
+
+    def print_parameters(self):
+        for k in parameter_names:
+            if k in self.parameters:
+                print k, register_map[k].describe(self.parameters[k])
+
         print
-        print 'Following-error limit updated to', fe_max, 'mm'
-        print 'Step scale factor updated to', step_scale, 'mm/step'
+        print 'Following-error limit updated to', self.fe_max * self.step_scale, 'mm'
+        print 'Step scale factor updated to', self.step_scale, 'mm/step'
 
 
     def scope_setup(self):
         # see notes at top of file regarding timing limitations and overhead
 
-        cmds = [
-          # the last word sets the duration in 10ms increments, i.e. 0x000a = 10 -> 10 * 10ms = 100ms
-          #['scope_setup1', None, None, [0x01, 0x06, 0x00, 0xD0, 0x01, 0x2C]], # 3000 ms sampling (~3097 ms total)
-          #['scope_setup1', None, None, [0x01, 0x06, 0x00, 0xD0, 0x00, 0x64]], # 1000 ms sampling (~1119 ms total)
-          #['scope_setup1', None, None, [0x01, 0x06, 0x00, 0xD0, 0x00, 0x28]], # 400 ms sampling (~527 ms total)
-          ['scope_setup1', None, None, [0x01, 0x06, 0x00, 0xD0, 0x00, 0x14]], # 200 ms sampling (~328 ms total)
-          #['scope_setup1', None, None, [0x01, 0x06, 0x00, 0xD0, 0x00, 0x0a]], # 100 ms sampling (~230 ms total)
-          ['scope_setup2', None, None, [0x01, 0x06, 0x00, 0x41, 0x00, 0x01]],
-          ['scope_setup3', None, None, [0x01, 0x06, 0x00, 0x42, 0x00, 0x00]]
-        ]
-
-        #'k4', None, None, [0x01, 0x06, 0x00, 0xD0, 0x00, 0x64]], # 1000 ms
-
-        self.run_cmds(cmds)
+        self.run_cmds(scope_setup_cmds)
+        self.scope_duration = .2
 
 
     def scope_exec(self, task):
-        cmds = [
-          ['scope_begin', None, None, [0x01, 0x06, 0x00, 0x14, 0x00, 0x01]], # begin
-          ['scope_check', None, None, [0x01, 0x03, 0x00, 0xDA, 0x00, 0x01]], # repeat until response[-1] == 0x02, waiting 100 millisec or so between
-          ['scope_end',   None, None, [0x01, 0x03, 0x00, 0x14, 0x00, 0xc8]]  # end
-        ]
-
-        # there are 200 samples regardless of sampling duration, each reading is a word
-        ns = 200
+        cmds = scope_cmds
 
-        timing.enable()
+        ns = scope_ns
 
         # see notes at top of file regarding timing limitations and overhead
         if task == 'begin':
             # request sampling of data of configured duration
-            t1.start()
             self.rt_s = time.time()
             self.run_cmd(cmds[0])
 
@@ -327,55 +736,49 @@ class LeadshineEasyServo:
 
             # check if sampling is complete
             if response[-1]  == 0x02:
-                self.rt_e = time.time()
-                self.run_cmd(cmds[2], False)
-                t1.lap()
+                # the bus is held from request to response
+                with self.lock:
+                    self.rt_e = time.time()
+                    ct = time.time()
+                    stage_seconds.observe(ct - self.rt_s, self.labels + ('request',))
 
-                # each reading is a word, so ns*2 bytes to read
-                t2.start()
-                msg = self.read_response(3+ns*2+2)
-                t2.lap()
+                    # each reading is a word, so ns*2 bytes to read
+                    n = self.transaction(cmds[2][3], self.scope_buf, 3+ns*2+2)
+                    stage_seconds.observe(time.time() - ct, self.labels + ('readout',))
+
+                if n is None:
+                    print 'scope_exec(): failed readout'
+                    return [], []
 
                 # starting the new sampling period immediately does not decrease the perceived overhead
                 #run_cmd(ser, cmds[0])
                 #print time.time()
                 #continue
 
-                # error = []
-                def h(v):
-                    v = (v[0] << 8) | (v[1])
-                    if v & 0x8000:
-                        v = -(v ^ 0xffff)
-                    return v
-                # join bytes of each word, and then convert to desired units
-                error = map(h, zip(msg[0::2], msg[1::2]))
-                error = map(lambda x: x * self.step_scale, error)
+                # scope_steps is a view of the big-endian signed words in scope_buf, convert to desired units
+                # the list returned is the only copy of the readout, and is retained by the caller
+                np.multiply(self.scope_steps, self.step_scale, out=self.scope_error)
+                error = self.scope_error.tolist()
                 #print time.time(), dt, len(error), error
-                t3.lap()
-                if timing.enabled:
-                    print 'last,min,avg,max', 'req:', t1, 'resp:', t2, 'total:', t3, 'graph:', t4
+
+                ct = time.time()
+                if self.t_block is not None:
+                    stage_seconds.observe(ct - self.t_block, self.labels + ('cycle',))
+                self.t_block = ct
+                blocks.inc(self.labels)
 
                 error_x = list(np.linspace(self.rt_s, self.rt_e, num=ns, endpoint=True))
 
                 return error, error_x
 
+            wasted_checks.inc(self.labels)
             return [], []
 
 
 
 
 
-    def motion_test(self):
-        cmds = [
-          ['velocity (rpm)',       None, None, [0x01, 0x03, 0x00, 0x16, 0x00, 0x01]],
-          ['acceleration (r/s/s)', None, None, [0x01, 0x03, 0x00, 0x15, 0x00, 0x01]],
-          ['intermission (ms)?',   None, None, [0x01, 0x03, 0x00, 0x1B, 0x00, 0x01]],
-          ['distance?',            None, None, [0x01, 0x03, 0x00, 0x19, 0x00, 0x01]],
-          ['trace time?',          None, None, [0x01, 0x03, 0x00, 0x18, 0x00, 0x01]],
-          ['motion direction?',    None, None, [0x01, 0x03, 0x00, 0x1A, 0x00, 0x01]],
-          ['motion mode?',         None, None, [0x01, 0x03, 0x00, 0x1C, 0x00, 0x01]]
-        ]
-
+    def motion_test(self, profile=None, setup=True):
         # f1 2 ['0x0', '0x3c'] 0x3c 60
         # f2 2 ['0x7', '0xd0'] 0x7d0 2000
         # f3 2 ['0x0', '0x64'] 0x64 100
@@ -384,95 +787,123 @@ class LeadshineEasyServo:
         # f6 2 ['0x0', '0x1'] 0x1 1
         # f7 2 ['0x0', '0x1'] 0x1 1
 
-        # read motion test parameters
-        self.run_cmds(cmds)
-
-        cmds = [
-          ['motion_test1',   None, None, [0x01, 0x06, 0x00, 0x15, 0x07, 0xD0]],
-          ['motion_test2',   None, None, [0x01, 0x06, 0x00, 0x18, 0x00, 0x64]],
-          ['motion_test3',   None, None, [0x01, 0x06, 0x00, 0x1B, 0x00, 0x64]],
-          ['motion_test4',   None, None, [0x01, 0x06, 0x00, 0x19, 0x00, 0x01]],
-          ['motion_test5',   None, None, [0x01, 0x06, 0x00, 0x16, 0x00, 0x3C]],
-
-          ['motion_test6',   None, None, [0x01, 0x06, 0x00, 0xD0, 0x00, 0x64]], # identical to scope setup
-          ['motion_test7',   None, None, [0x01, 0x06, 0x00, 0x41, 0x00, 0x01]], # identical to scope setup
-          ['motion_test8',   None, None, [0x01, 0x06, 0x00, 0x42, 0x00, 0x00]], # identical to scope setup
+        # profile defaults to motion_profile, without setup the profile and scope of the previous test are reused,
+        # so repeated tests start back to back
+        if setup:
+            # read motion test parameters
+            self.read_registers(motion_reads)
 
-          ['motion_test9',   None, None, [0x01, 0x06, 0x00, 0x09, 0x00, 0x01]] # unique
-        ]
+            self.write_parameters(profile if profile is not None else motion_profile)
+            self.run_cmds(motion_test_cmds[:3])
+            self.scope_duration = 1.
 
         # execute motion test
-        self.run_cmds(cmds)
-        self.scope_exec()
+        self.run_cmd(motion_test_cmds[3])
+
+        return self.capture()
+
+
+    def current_test(self, kp=None, ki=None, step=0x200, wait=.1):
+        # step response of the current loop, returns the 200 signed samples of the current, or None
+        # kp and ki default to the gains already in the drive, step is the current commanded
+        #
+        # sequence seen from ProTuner, with the time of each request and response:
+        #   current_test1     -16.32us  1.779ms  [0x01, 0x06, 0x00, 0x00, 0x02, 0x85]   current loop kp
+        #   current_test2     52.85ms   54.64ms  [0x01, 0x06, 0x00, 0x01, 0x01, 0x25]   current loop ki
+        #   current_test3     115.3ms   117.2ms  [0x01, 0x06, 0x00, 0x04, 0x02, 0x00]   current test step
+        #   current_test4     177.6ms   272.7ms  [0x01, 0x06, 0x00, 0x41, 0x00, 0x08]   scope channel, current
+        #                                        [0x01, 0x06, 0x00, 0x02, 0x00, 0x01]   current test start, sent with the above
+        #   current_test5     370.4ms   463.4ms  [0x01, 0x03, 0x00, 0x05, 0x00, 0xC8]   200 words, the same byte count as the scope readout
+        #   current_test end  5.752s    5.754s   [0x01, 0x06, 0x00, 0x02, 0x00, 0x00]
+        values = {'current test step': step}
+        if kp is not None:
+            values['current loop kp'] = kp
+        if ki is not None:
+            values['current loop ki'] = ki
+
+        with self.lock:
+            if not self.write_parameters(values):
+                print 'current_test(): failed to write', values
+                return None
 
+            if not self.write_frames(current_test_start_cmds):
+                print 'current_test(): failed to start'
+                return None
 
-    def current_test(self):
-        cmds = [
-          ['current_test1',    None, None, [0x01, 0x06, 0x00, 0x00, 0x02, 0x85]], #        -16.32us        1.779ms [0x01, 0x06, 0x00, 0x00, 0x02, 0x85, 0x49, 0x09]
-          ['current_test2',    None, None, [0x01, 0x06, 0x00, 0x01, 0x01, 0x25]], #        52.85ms 54.64ms         [0x01, 0x06, 0x00, 0x01, 0x01, 0x25, 0x18, 0x41]
-          ['current_test3',    None, None, [0x01, 0x06, 0x00, 0x04, 0x02, 0x00]], #        115.3ms 117.2ms         [0x01, 0x06, 0x00, 0x04, 0x02, 0x00, 0xC9, 0x6B]
-          ['current_test4',    None, None, [0x01, 0x06, 0x00, 0x41, 0x00, 0x08]], #        177.6ms 272.7ms         [0x01, 0x06, 0x00, 0x41, 0x00, 0x08, 0xD8, 0x18, 0x01, 0x06, 0x00, 0x02, 0x00, 0x01, 0xE9, 0xCA]
-          ['current_test5',    None, None, [0x01, 0x03, 0x00, 0x05, 0x00, 0xC8]], #        370.4ms 463.4ms         [0x01, 0x03, 0x90, 0x00, 0x20, 0x00, 0x20, 0x00, 0x2B, 0x00, 0x15, 0x00, 0x15, 0x00, 0x2B, 0x00, 0x20, 0x00, 0x2B, 0x00, 0x20, 0x00, 0x0A, 0x00, 0x20, 0x00, 0x2B, 0x00, 0xD0, 0x01, 0x5F, 0x01, 0xB7, 0x01, 0xF9, 0x02, 0x04, 0x02, 0x04, 0x01, 0xF9, 0x02, 0x04, 0x02, 0x04, 0x02, 0x04, 0x02, 0x0F, 0x01, 0xEE, 0x02, 0x04, 0x02, 0x04, 0x02, 0x0F, 0x02, 0x04, 0x02, 0x0F, 0x01, 0xF9, 0x01, 0xF9, 0x02, 0x0F, 0x01, 0xF9, 0x01, 0xF9, 0x02, 0x0F, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xF9, 0x02, 0x04, 0x01, 0xF9, 0x02, 0x04, 0x02, 0x04, 0x02, 0x04, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xF9, 0x01, 0xF9, 0x02, 0x04, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xF9, 0x01, 0xE3, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xEE, 0x01, 0xF9, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xE3, 0x01, 0xD8, 0x01, 0xE3, 0x01, 0xF9, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x02, 0x04, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xE3, 0x01, 0xEE, 0x01, 0xD8, 0x01, 0xEE, 0x01, 0xF9, 0x01, 0xE3, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xE3, 0x01, 0xF9, 0x02, 0x04, 0x02, 0x04, 0x02, 0x0F, 0x01, 0xF9, 0x01, 0xE3, 0x01, 0xF9, 0x01, 0xEE, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xF9, 0x01, 0xF9, 0x02, 0x04, 0x01, 0xF9, 0x01, 0xF9, 0x02, 0x04, 0x02, 0x1A, 0x01, 0xEE, 0x01, 0xF9, 0x02, 0x04, 0x02, 0x04, 0x02, 0x04, 0x01, 0xEE, 0x02, 0x04, 0x01, 0xF9, 0x02, 0x0F, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x01, 0xEE, 0x02, 0x0F, 0x02, 0x1A, 0x02, 0x1A, 0x01, 0xE3, 0x01, 0xF9, 0x02, 0x04, 0x02, 0x04, 0x02, 0x0F, 0x02, 0x04, 0x02, 0x04, 0x02, 0x04, 0x01, 0xE3, 0x01, 0xF9, 0x02, 0x04, 0x01, 0x49, 0x00, 0xAF, 0x00, 0x4C, 0x00, 0x2B, 0x00, 0x20, 0x00, 0x20, 0x00, 0x15, 0x00, 0x0A, 0x00, 0x0A, 0x00, 0x20, 0x00, 0x20, 0x00, 0x20, 0x00, 0x15, 0x00, 0x15, 0x00, 0x20, 0x00, 0x15, 0x00, 0x20, 0x00, 0x20, 0x00, 0x41, 0x00, 0x15, 0x00, 0x00, 0x00, 0x0A, 0x00, 0x15, 0x00, 0x0A, 0x00, 0x0A, 0x00, 0x0A, 0x00, 0x0A, 0x00]
-          ['current_test end', None, None, [0x01, 0x06, 0x00, 0x02, 0x00, 0x00]] #       5.752s  5.754s          [0x01, 0x06, 0x00, 0x02, 0x00, 0x00, 0x28, 0x0A]
-        ]
+            time.sleep(wait)
+
+            n = self.transaction(current_test_read_cmd, self.scope_buf, 3 + scope_ns * 2 + 2)
 
-        self.run_cmd(cmds[0], False)
-        msg = self.read_response(8)
-        print map(hex, msg)
+            # the scope buffer is reused, so the samples are copied
+            current = None if n is None else self.scope_steps.astype(np.int32)
 
-        self.run_cmd(cmds[1], False)
-        msg = self.read_response(8)
-        print map(hex, msg)
+            # end the test, and return the scope to the following-error for scope_setup() and motion_test()
+            self.write_frames(current_test_end_cmds)
 
-        self.run_cmd(cmds[2], False)
-        msg = self.read_response(8)
-        print map(hex, msg)
+        if current is None:
+            print 'current_test(): failed readout'
+        return current
 
-        self.run_cmd(cmds[3], False)
-        msg = self.read_response(8)
-        print map(hex, msg)
-        msg = self.read_response(8)
-        if msg:
-            print map(hex, msg)
 
-        self.run_cmd(cmds[4], False)
-        msg = self.read_response(405)
-        #print map(hex, msg)
+    def capture(self, timeout=5.):
+        # one complete scope cycle, begin and then retrieve once sampling is complete
+        self.scope_exec('begin')
 
-        def h(v):
-            v = (v[0] << 8) | (v[1])
-            if v & 0x8000:
-                v = -(v ^ 0xffff)
-            return v
-        # combine bytes into words and convert to signed integers
-        error = map(h, zip(msg[0::2], msg[1::2]))
-        print error
+        t_end = time.time() + self.scope_duration + timeout
+        while time.time() < t_end:
+            time.sleep(.01)
+            error, error_x = self.scope_exec('retrieve')
+            if error != []:
+                return error, error_x
 
-        self.run_cmd(cmds[5], False)
-        msg = self.read_response(8)
-        print map(hex, msg)
+        print 'capture(): timed out'
+        return [], []
 
 
     def scope(self):
         self.scope_setup()
-        self.scope_exec()
+        return self.capture()
 
 
     def open_serial(self, serial_port):
         self.serial_port = serial_port
+        self.labels = (str(serial_port), str(self.slave))
+
+        # drives with different slave addresses on a multi-drop RS-485 line share the port and its lock
+        with shared_ports_lock:
+            if serial_port in shared_ports:
+                self.ser, self.lock, self.queue = shared_ports[serial_port]
+                return
+
+            self.ser = serial.Serial(port=self.serial_port, baudrate=baudrate, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=1, xonxoff=False, rtscts=False, dsrdtr=False) #, write_timeout=None, dsrdtr=False) #, inter_byte_timeout=None)
+
+            #ser.reset_input_buffer()
+            #ser.reset_output_buffer()
+            self.ser.flushInput()
+            self.ser.flushOutput()
+
+            self.drain()
 
-        self.ser = serial.Serial(port=self.serial_port, baudrate=38400, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=1, xonxoff=False, rtscts=False, dsrdtr=False) #, write_timeout=None, dsrdtr=False) #, inter_byte_timeout=None)
+            # background transactions of all drives on the port are queued together
+            self.queue = TransactionQueue(self.lock)
 
-        #ser.reset_input_buffer()
-        #ser.reset_output_buffer()
-        self.ser.flushInput()
-        self.ser.flushOutput()
+            shared_ports[serial_port] = (self.ser, self.lock, self.queue)
 
-        # clear input (what do the previous flush command actually do?)
+
+    def drain(self, quiet=.02, deadline=.25):
+        # clear input that arrives after the flush, e.g. the tail of a response to a previous session
+        # returns once the line has been quiet for quiet seconds, or after deadline seconds, without blocking on read()
+        t_end = time.time() + deadline
+        t_quiet = time.time() + quiet
         while True:
-            v = self.ser.read(1)
-            if len(v) == 0:
+            n = self.ser.in_waiting
+            if n:
+                self.ser.read(n)
+                t_quiet = time.time() + quiet
+            ct = time.time()
+            if ct >= t_quiet or ct >= t_end:
                 break
+            time.sleep(.002)
 
 
     def other_cmds(self):
@@ -490,8 +921,8 @@ class LeadshineEasyServo:
 
 
     def read_alarms(self):
-        # have only seen 1) position following error and 2) no error. might be support for multiple errors or a history of errors
-        # little of the response has been decoded
+        # have only seen 1) position following error and 2) no error
+        # the first word is the active alarm and the other nine appear to be a history of earlier alarms, see alarm_bits
 
 #Frame000 RX 521929384: 1 3 2 0 20 B9 9C
 #Frame000 TX 540022464: 1 3 0 10 0 A C4 8
@@ -503,23 +934,117 @@ class LeadshineEasyServo:
 #Frame000 RX 1021987804: 1 3 14 0 0 0 20 0 2 0 20 0 0 0 0 0 0 0 0 0 0 0 0 47 CC
 #Frame000 TX 1022070496: 1 3 0 10 0 1 85 CF
 
-        cmds = [
-        ['read alarms1', None, None, [0x01, 0x03, 0x00, 0x10, 0x00, 0x0A]],
-        ['read alarms2', None, None, [0x01, 0x03, 0x00, 0x10, 0x00, 0x01]]
-        ]
+        response = self.run_frame(alarm_history_read)
+        if response is None or len(response) != 2 * (1 + alarm_history_len):
+            print 'Alarm: no response'
+            return None
 
-        self.run_cmd(cmds[0], False)
-        msg = self.read_response(25)
-        #print map(hex, msg)
+        # decode word by word, the active alarm word and then the history
+        words = [(response[2 * i] << 8) | response[2 * i + 1] for i in range(1 + alarm_history_len)]
+        active = decode_alarm(words[0])
+        history = [decode_alarm(w) for w in words[1:] if w]
 
-        msg = map(int, msg)
-        if   msg == [0x00, 0x20, 0x00, 0x20, 0x00, 0x02, 0x00, 0x20, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]:
+        if 'position following error' in active:
             print 'Alarm: No 0: Position Follow Error - Repower the drive!'
-        elif msg == [0x00, 0x00, 0x00, 0x20, 0x00, 0x02, 0x00, 0x20, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]:
-            print 'Alarm: No errors'
+        elif active:
+            print 'Alarm:', ', '.join(active)
         else:
-            print 'Alarm: Unknown message: ', msg
-        self.run_cmd(cmds[1], False)
+            print 'Alarm: No errors'
+        if history:
+            print 'Alarm history:', '; '.join(', '.join(h) for h in history)
+
+        self.alarm_word = words[0]
+
+        return {'active': active, 'history': history}
+
+
+    def poll_alarms(self):
+        # read the active alarm word and report every change as an event, meant to run from the transaction queue
+        # returns the events, each (time, 'raised' or 'cleared', name)
+        response = self.run_frame(alarm_read)
+        if response is None or len(response) != 2:
+            return []
+
+        word = (response[0] << 8) | response[1]
+        ct = time.time()
+        events = [(ct,) + e for e in alarm_events(self.alarm_word, word)]
+        self.alarm_word = word
+
+        for e in events:
+            print 'Alarm', self.serial_port, self.slave, e[1] + ':', e[2]
+            if self.on_alarm is not None:
+                self.on_alarm(self, e)
+
+        return events
+
+
+    def poll_parameters(self):
+        # reread the parameters, reporting any changed by other software, meant to run from the transaction queue
+        old = getattr(self, 'parameters', {})
+        try:
+            rv = self.read_parameters(False)
+        except IOError as e:
+            print 'poll_parameters():', e
+            return old
+        for k in parameter_names:
+            if k in old and k in rv and old[k] != rv[k]:
+                print 'Parameter', self.serial_port, self.slave, k, 'changed from', old[k], 'to', rv[k]
+        return rv
+
+
+def for_each_drive(drives, f):
+    # call f(drive) for every drive at once, one thread per drive
+    # drives on different serial ports are independent, so the total time is that of the slowest drive
+    # drives maps names to drives, and the results are returned keyed the same way
+    rv = {}
+
+    def g(k, es):
+        rv[k] = f(es)
+
+    threads = [threading.Thread(target=g, args=(k, es)) for k, es in drives.items()]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+    return rv
+
+
+def open_drives(serial_ports, read_parameters=True):
+    # open, introduce, and read the parameters of all drives at once
+    # serial_ports maps names to serial ports, or to (serial port, slave address) for drives sharing a
+    # multi-drop RS-485 line, and the drives are returned keyed the same way
+    # exits if any drive fails to respond
+    def bring_up(v):
+        serial_port, slave = v if isinstance(v, tuple) else (v, slave_address)
+
+        es = LeadshineEasyServo(slave)
+        es.open_serial(serial_port)
+
+        if not es.send_introduction():
+            return 'failed introduction'
+
+        if read_parameters:
+            try:
+                es.read_parameters(False)
+            except IOError as e:
+                return str(e)
+
+        return es
+
+    ess = for_each_drive(serial_ports, bring_up)
+
+    for k in sorted(serial_ports):
+        if not isinstance(ess.get(k), LeadshineEasyServo):
+            print 'open_drives():', ess.get(k, 'failed to open'), k, serial_ports[k]
+            sys.exit(1)
+
+        if read_parameters:
+            print
+            print k
+            ess[k].print_parameters()
+
+    return ess
 
 
 def main():
@@ -541,7 +1066,7 @@ def main():
         es.read_parameters()
 
     if 'current_test' in cmds:
-        es.current_test()
+        print es.current_test().tolist()
 
     if 'latest' in cmds:
         es.latest_cmds(ser)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Streaming smoothing of the following-error
+#
+# The error is quantized to whole encoder pulses, step_scale mm, so the raw samples are noisy.
+# Each filter carries its state from one block to the next, so a block is filtered as if it
+# continued the previous one, and there is no seam at block edges. The readout gap between blocks
+# is bridged the same way, unless it is longer than reset_gap seconds, in which case the filter
+# starts over from the new block. Each block is filtered with array operations only.
+
+
+import numpy as np
+
+
+class LowPass:
+    # first order IIR low-pass, y[i] = a y[i-1] + (1 - a) x[i]
+    def __init__(self, cutoff, dt):
+        self.a = np.exp(-2. * np.pi * cutoff * dt)
+        self.y = None
+
+        # y over a block is a^i times a cumulative sum of x scaled by a^-i, which is split into pieces
+        # short enough that a^-i stays well within range
+        self.piece = max(1, int(600. / -np.log(self.a))) if self.a > 0. else 1
+
+
+    def reset(self):
+        self.y = None
+
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        rv = np.empty(len(x))
+        if len(x) == 0:
+            return rv
+        if self.y is None:
+            self.y = x[0]
+
+        for i in range(0, len(x), self.piece):
+            xp = x[i:i + self.piece]
+            p = self.a ** np.arange(1, len(xp) + 1)
+            rv[i:i + len(xp)] = p * (self.y + (1. - self.a) * np.cumsum(xp / p))
+            self.y = rv[i + len(xp) - 1]
+
+        return rv
+
+
+class MovingAverage:
+    # mean of the last n samples
+    def __init__(self, n):
+        self.n = n
+        self.tail = None
+
+
+    def reset(self):
+        self.tail = None
+
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if len(x) == 0:
+            return x
+        if self.tail is None:
+            # start as if the first sample had been held
+            self.tail = np.full(self.n - 1, x[0])
+
+        v = np.concatenate((self.tail, x))
+        c = np.cumsum(v)
+        c[self.n:] -= c[:-self.n].copy()
+        self.tail = v[len(v) - (self.n - 1):]
+        return c[self.n - 1:] / self.n
+
+
+class RunningMedian:
+    # median of the last n samples
+    def __init__(self, n):
+        self.n = n
+        self.tail = None
+
+
+    def reset(self):
+        self.tail = None
+
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if len(x) == 0:
+            return x
+        if self.tail is None:
+            self.tail = np.full(self.n - 1, x[0])
+
+        v = np.concatenate((self.tail, x))
+        # one row per output sample, a view of the n samples ending at it
+        windows = np.lib.stride_tricks.as_strided(v, shape=(len(x), self.n), strides=(v.strides[0], v.strides[0]))
+        self.tail = v[len(v) - (self.n - 1):]
+        return np.median(windows, axis=1)
+
+
+filter_types = {
+    'lowpass': lambda v, dt: LowPass(v, dt),
+    'average': lambda v, dt: MovingAverage(int(v)),
+    'median':  lambda v, dt: RunningMedian(int(v)),
+}
+
+
+class FilterChain:
+    # filters applied in order, specs is a list of (type, value), e.g. [('median', 5), ('lowpass', 50.)]
+    # for a lowpass the value is the cutoff in Hz, otherwise the number of samples
+    def __init__(self, specs, dt, reset_gap=None):
+        self.filters = [filter_types[k](v, dt) for k, v in specs]
+        self.reset_gap = reset_gap
+
+
+    def update(self, error, gap=0.):
+        # error is one block, gap is the time in seconds since the previous block, returns the filtered block
+        if self.reset_gap is not None and gap > self.reset_gap:
+            for f in self.filters:
+                f.reset()
+
+        y = np.asarray(error, dtype=np.float64)
+        for f in self.filters:
+            y = f.update(y)
+        return y
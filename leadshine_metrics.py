@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Metrics in the Prometheus text format, served over HTTP on a thread of their own
+#
+# Counters and histograms are updated in place on the hot path, without locks. Each series, one
+# set of label values, is written by one thread at a time, as each drive is used from one thread
+# at a time, and the scraping thread only reads, so under the GIL no update is lost and a scrape
+# sees each series as of some recent update. Values that are already kept elsewhere, such as the
+# coverage and the statistics of each axis, are not duplicated, a collector function reads them
+# when the endpoint is scraped.
+#
+#   curl http://localhost:9108/metrics
+
+
+import bisect
+import threading
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+# metric name -> metric, in the order made
+registry = {}
+registry_order = []
+
+# functions returning [(name, type, help, [(labels dict, value)])], called on each scrape
+collectors = []
+
+
+def format_labels(names, values, extra=''):
+    v = ['{0}="{1}"'.format(k, str(x).replace('\\', '\\\\').replace('"', '\\"')) for k, x in zip(names, values)]
+    if extra:
+        v += [extra]
+    return '{' + ','.join(v) + '}' if v else ''
+
+
+def format_value(v):
+    if isinstance(v, (int, long)):
+        return str(v)
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v))
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # label values -> count
+        self.values = {}
+        register(self)
+
+
+    def inc(self, labels=(), n=1):
+        self.values[labels] = self.values.get(labels, 0) + n
+
+
+    def render(self):
+        rv = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} counter'.format(self.name)]
+        for k, v in sorted(self.values.items()):
+            rv += ['{0}{1} {2}'.format(self.name, format_labels(self.labels, k), format_value(v))]
+        return rv
+
+
+class Histogram:
+    # latencies from 1 ms to 5 s
+    default_buckets = [.001, .0025, .005, .01, .025, .05, .075, .1, .15, .2, .3, .5, 1., 2.5, 5.]
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = list(buckets if buckets is not None else Histogram.default_buckets)
+        # label values -> [count of each bucket, and of +Inf, not cumulative], [sum]
+        self.values = {}
+        register(self)
+
+
+    def observe(self, v, labels=()):
+        s = self.values.get(labels)
+        if s is None:
+            s = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.])
+        s[0][bisect.bisect_left(self.buckets, v)] += 1
+        s[1][0] += v
+
+
+    def render(self):
+        rv = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} histogram'.format(self.name)]
+        for k, (counts, total) in sorted(self.values.items()):
+            counts = list(counts)
+            n = 0
+            for le, c in zip(self.buckets + [float('inf')], counts):
+                n += c
+                rv += ['{0}_bucket{1} {2}'.format(self.name, format_labels(self.labels, k, 'le="{0}"'.format(format_value(le))), n)]
+            rv += ['{0}_sum{1} {2}'.format(self.name, format_labels(self.labels, k), format_value(total[0]))]
+            rv += ['{0}_count{1} {2}'.format(self.name, format_labels(self.labels, k), n)]
+        return rv
+
+
+def register(metric):
+    if metric.name not in registry:
+        registry_order.append(metric.name)
+    registry[metric.name] = metric
+
+
+def render():
+    rv = []
+    for name in registry_order:
+        rv += registry[name].render()
+
+    for f in collectors:
+        try:
+            metrics = f()
+        except Exception as e:
+            # a collector must not take the endpoint down, e.g. while the acquisition is starting
+            print 'render(): collector failed', e
+            continue
+        for name, type, help, samples in metrics:
+            rv += ['# HELP {0} {1}'.format(name, help), '# TYPE {0} {1}'.format(name, type)]
+            for labels, v in samples:
+                names = sorted(labels)
+                rv += ['{0}{1} {2}'.format(name, format_labels(names, [labels[k] for k in names]), format_value(v))]
+
+    return '\n'.join(rv) + '\n'
+
+
+def axis_collector(coverage, stats=None):
+    # a collector of the coverage, and optionally the WindowStats, of each axis, both dicts keyed by axis
+    def f():
+        rv = [('leadshine_coverage_ratio', 'gauge', 'Fraction of time sampled over the last window',
+               [({'axis': k}, v.rolling()) for k, v in sorted(coverage.items())]),
+              ('leadshine_coverage_all_time_ratio', 'gauge', 'Fraction of time sampled since the start',
+               [({'axis': k}, v.ratio()) for k, v in sorted(coverage.items())]),
+              ('leadshine_gap_seconds', 'gauge', 'Blind time before the last block',
+               [({'axis': k}, v.gap) for k, v in sorted(coverage.items())])]
+        if stats is not None:
+            for name, help, g in [('mean', 'Mean', lambda v: v.mean()), ('rms', 'RMS', lambda v: v.rms()),
+                                  ('min', 'Minimum', lambda v: v.min()), ('max', 'Maximum', lambda v: v.max())]:
+                rv += [('leadshine_following_error_{0}_mm'.format(name), 'gauge', help + ' following-error over the plot window',
+                        [({'axis': k}, g(v)) for k, v in sorted(stats.items())])]
+        return rv
+    return f
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, fmt, *args):
+        # not every scrape
+        pass
+
+
+def start_server(address=('127.0.0.1', 9108)):
+    # serve the metrics from a daemon thread, returns the server
+    server = HTTPServer(address, MetricsHandler)
+    th = threading.Thread(target=server.serve_forever)
+    th.daemon = True
+    th.start()
+    print 'Metrics at http://{0}:{1}/metrics'.format(*server.server_address)
+    return server
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Repeatability of the motion test
+#
+# The motion profile is written once, and the motion test is then run n_runs times back to back on
+# every axis at once. The following-error of the runs of an axis is stacked into a (runs, samples)
+# array. Runs can start a few samples apart, as the scope is begun after the motion is, so each
+# run is first aligned to the first run by the shift, within max_shift samples, that best
+# correlates them. From the aligned runs:
+#   mean, std            per sample, the envelope of the axis
+#   spread               per sample, max - min over the runs
+#   repeatability        rms over all samples of the deviation of the runs from the mean
+#   run deviation        per run, the rms deviation from the mean, an outlier stands out here
+# Each axis is saved to prefix-axis.npz, and summarized on the console.
+
+
+import sys
+import time
+
+import numpy as np
+
+from leadshine_easyservo import *
+
+
+serial_ports = {'x-axis': '/dev/ttyUSB0',
+                'y-axis': '/dev/ttyUSB1',
+                'z-axis': '/dev/ttyUSB2'}
+
+# the motion test screen, see motion_registers
+profile = dict(motion_profile)
+
+n_runs = 10
+
+# largest shift, in samples, used to align the runs
+max_shift = 10
+
+results_prefix = 'motion_test'
+
+
+def align(traces, max_shift=max_shift):
+    # shift each run to best correlate with the first, samples shifted in from outside the run are nan
+    # returns the aligned runs and the shift of each
+    n, ns = traces.shape
+    x = traces - traces.mean(axis=1)[:, None]
+
+    # circular cross-correlation of every run with the first at once, zero padded so it is linear
+    nfft = 2 * ns
+    f = np.fft.rfft(x, nfft, axis=1)
+    cc = np.fft.irfft(f * np.conj(f[0]), nfft, axis=1)
+    lags = np.concatenate((np.arange(0, max_shift + 1), np.arange(-max_shift, 0)))
+    shifts = lags[np.argmax(cc[:, lags], axis=1)]
+
+    # aligned[i, j] = traces[i, j + shifts[i]]
+    idx = np.arange(ns)[None, :] + shifts[:, None]
+    valid = (idx >= 0) & (idx < ns)
+    aligned = np.where(valid, traces[np.arange(n)[:, None], np.clip(idx, 0, ns - 1)], np.nan)
+    return aligned, shifts
+
+
+def ensemble(traces):
+    # statistics of the aligned runs, a (runs, samples) array with nan where a run has no sample
+    mean = np.nanmean(traces, axis=0)
+    std = np.nanstd(traces, axis=0)
+    dev = traces - mean[None, :]
+
+    return {
+        'mean': mean,
+        'std': std,
+        'spread': np.nanmax(traces, axis=0) - np.nanmin(traces, axis=0),
+        'repeatability': np.sqrt(np.nanmean(dev ** 2)),
+        'run deviation': np.sqrt(np.nanmean(dev ** 2, axis=1)),
+    }
+
+
+class MotionRunner:
+    def __init__(self, drives, profile=profile):
+        self.drives = drives
+        self.profile = profile
+
+
+    def run_axis(self, es, runs):
+        # runs of the motion test on one drive, returns a (runs, samples) array of following-error, in mm
+        traces = []
+        times = []
+        for i in range(runs):
+            error, error_x = es.motion_test(self.profile, setup=(i == 0))
+            if error == []:
+                print 'run_axis(): motion test failed', es.serial_port, i
+                continue
+            traces += [error]
+            times += [error_x[-1] - error_x[0]]
+        if not traces:
+            return None
+        return np.array(traces), np.array(times)
+
+
+    def run(self, runs=n_runs, prefix=results_prefix):
+        st = time.time()
+        rv = for_each_drive(self.drives, lambda es: self.run_axis(es, runs))
+        print 'Motion tests completed in {0:.1f} s'.format(time.time() - st)
+
+        results = {}
+        for k in sorted(rv):
+            if rv[k] is None:
+                continue
+            traces, times = rv[k]
+            aligned, shifts = align(traces)
+            m = ensemble(aligned)
+            results[k] = m
+
+            np.savez_compressed('{0}-{1}.npz'.format(prefix, k), traces=traces, aligned=aligned, shifts=shifts,
+                                times=times, step_scale=self.drives[k].step_scale, **dict((n.replace(' ', '_'), v) for n, v in m.items()))
+
+            worst = np.argmax(m['run deviation'])
+            print k, len(traces), 'runs',
+            print 'repeatability: {0:.4f} mm max std: {1:.4f} mm max spread: {2:.4f} mm worst run: {3} ({4:.4f} mm) shifts: {5}'.format(
+                m['repeatability'], np.nanmax(m['std']), np.nanmax(m['spread']), worst, m['run deviation'][worst], list(shifts))
+
+        return results
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else n_runs
+
+    ess = open_drives(serial_ports)
+    MotionRunner(ess).run(runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,7 @@
 # Originally begun August 23, 2016
 
 
+import bisect
 import sys
 import serial
 import time
@@ -47,27 +48,86 @@ except AttributeError:
 
 from timing import *
 from leadshine_easyservo import *
-
-
+from leadshine_acquire import *
+from leadshine_server import LeadshineClient
+from leadshine_record import Recorder
+from leadshine_trigger import Trigger
+from leadshine_filter import FilterChain
+from leadshine_contour import Contour
+import leadshine_metrics
+from leadshine_spectrum import *
+from leadshine_stats import *
+
+
+# drives sharing a multi-drop RS-485 line are given as (serial port, slave address), e.g.
+# {'x-axis': ('/dev/ttyUSB0', 1), 'y-axis': ('/dev/ttyUSB0', 2), 'z-axis': ('/dev/ttyUSB0', 3)}
 serial_ports = {'x-axis': '/dev/ttyUSB0',
                 'y-axis': '/dev/ttyUSB1',
                 'z-axis': '/dev/ttyUSB2'}
 
+# subscribe to a leadshine_server rather than opening the serial ports, e.g. ('localhost', 5555)
+server_address = None
+
+# record all blocks, with a multi-resolution index, to files starting with this prefix, see leadshine_record
+record_prefix = None
+
+# smoothing of the following-error of each axis before it is plotted and checked by the trigger, see leadshine_filter
+# e.g. {'x-axis': [('median', 5), ('lowpass', 50.)]}, the statistics, spectrum, recording, and contour use the raw error
+filters = {}
+# restart the filters after a gap between blocks longer than this many seconds, None to always continue
+filter_reset_gap = None
+
+# write the following-error of all axes around each excursion to files starting with this prefix, see leadshine_trigger
+snapshot_prefix = None
+# the magnitude of the error, in mm, crossing the level on the edge ('rising', 'falling', or 'either') fires the trigger
+trigger_level = .05
+trigger_edge = 'rising'
+trigger_pre_sec = 1.
+trigger_post_sec = 1.
+# minimum time between snapshots
+trigger_holdoff_sec = 10.
+
+# combined error of these axes, e.g. ['x-axis', 'y-axis', 'z-axis'], printed with the resonances, see leadshine_contour
+contour_axes = None
+
+# serve counters and latency histograms of the drives, and the coverage and statistics of each axis, e.g. ('127.0.0.1', 9108)
+metrics_address = None
+
+# one subplot per axis, redrawn together, rather than all axes in a single graph
+dashboard = False
+# rows, columns of the dashboard, one column by default
+dashboard_layout = None
+dashboard_max_fps = 10.
+
 # retain only the last X seconds of data for graph
 last_x_sec = 5
 
+# power spectral density of the following-error, drawn in a second panel and/or printed
+show_spectrum = False
+print_resonances = True
+# print the resonances every X blocks
+resonance_report_blocks = 10
+
+# print the fraction of time sampled, with the resonances
+print_coverage = True
+
 
 class Plot:
     zoom_plot_fe_max = False
     position_error_label = 'position error (mm)'
     ns = 200
 
-    ylimits_max = [0, 0]
     ylimits = [-1, 1]
     ax = None
+    ax_psd = None
+
 
+    def __init__(self, ax=None, ax_psd=None):
+        # by default all axes share the single graph made by setup_graph(), a Dashboard gives each its own
+        self.ax = ax if ax is not None else Plot.ax
+        self.ax_psd = ax_psd if ax_psd is not None else Plot.ax_psd
 
-    def __init__(self):
+        self.name = None
         self.line_error = None
         self.line_min = None
         self.line_max = None
@@ -75,6 +135,7 @@ class Plot:
         self.text_min = None
         self.text_max = None
         self.text_avg = None
+        self.line_psd = None
         self.fe_lims = {'-fe limit': 0, '+fe limit': 0}
 
 
@@ -82,7 +143,14 @@ class Plot:
     def setup_graph():
         fig = plt.figure()
         fig.canvas.set_window_title('Following-error')
-        Plot.ax = fig.add_subplot(1, 1, 1)
+        if show_spectrum:
+            Plot.ax = fig.add_subplot(2, 1, 1)
+            Plot.ax_psd = fig.add_subplot(2, 1, 2)
+            Plot.ax_psd.set_xlabel('frequency (Hz)')
+            Plot.ax_psd.set_ylabel('psd (mm^2/Hz)')
+            Plot.ax_psd.set_yscale('log')
+        else:
+            Plot.ax = fig.add_subplot(1, 1, 1)
         Plot.ax.set_xlabel('time (s)')
         Plot.ax.set_ylabel(Plot.position_error_label)
         plt.ion()
@@ -90,37 +158,52 @@ class Plot:
 
 
     def add_graph(self, ame, fe_max):
+        self.name = ame
         self.fe_lims = {'-fe limit': -fe_max, '+fe limit': fe_max}
 
         for k,v in self.fe_lims.items():
-            plt.axhline(y=v, color='b', linestyle='-')
-            plt.text(0, v, k)
+            self.ax.axhline(y=v, color='b', linestyle='-')
+            self.ax.text(0, v, k)
 
         # using a linestyle='' and a marker, we have a faster scatter plot than plt.scatter
-        self.line_error, = Plot.ax.plot(range(Plot.ns), range(Plot.ns), linestyle='', marker='.') #, marker='o', markersize=4)
+        self.line_error, = self.ax.plot(range(Plot.ns), range(Plot.ns), linestyle='', marker='.') #, marker='o', markersize=4)
         # scatter plot helps to see the communication overhead, but is many times slower than line plot
-        #sct_error = Plot.ax.scatter(range(Plot.ns), range(Plot.ns), marker='o')
-        self.line_min = plt.axhline(y=0, color='r', linestyle='-')
-        self.line_max = plt.axhline(y=0, color='r', linestyle='-')
-        self.line_avg = plt.axhline(y=0, color='g', linestyle='-')
-        self.text_min = plt.text(0, 0, '')
-        self.text_max = plt.text(0, 0, '')
-        self.text_avg = plt.text(0, 0, '')
+        #sct_error = self.ax.scatter(range(Plot.ns), range(Plot.ns), marker='o')
+        self.line_min = self.ax.axhline(y=0, color='r', linestyle='-')
+        self.line_max = self.ax.axhline(y=0, color='r', linestyle='-')
+        self.line_avg = self.ax.axhline(y=0, color='g', linestyle='-')
+        self.text_min = self.ax.text(0, 0, '')
+        self.text_max = self.ax.text(0, 0, '')
+        self.text_avg = self.ax.text(0, 0, '')
+
+        if self.ax_psd is not None:
+            self.line_psd, = self.ax_psd.plot([], [], label=ame)
+            self.ax_psd.legend()
+
+
+    def plot_spectrum(self, spectrum):
+        # drawn with the next plot_error()
+        if self.line_psd is None or spectrum.n == 0:
+            return
+
+        # skip the dc bin, it is removed before the transform
+        self.line_psd.set_data(spectrum.freq[1:], spectrum.psd[1:])
+        self.ax_psd.relim()
+        self.ax_psd.autoscale_view()
+
+
+    def plot_error(self, cummul_error, cummul_error_x, stats, draw=True, coverage=None):
+        # stats is the WindowStats of this axis, kept up to date as blocks arrive
+        # the gaps between blocks are nan in cummul_error, breaking the line
+        # with draw=False only the artists are updated, and a Dashboard redraws all axes at once
+        if cummul_error != []:
+            avg_error = stats.mean()
+            #avg_error = stats.percentile(50)
 
+            # the all-time extremes are per axis
+            ylimits_max = [stats.all_min, stats.all_max]
 
-    def plot_error(self, cummul_error, cummul_error_x):
-        if cummul_error != []:
-            #ylimits[0] = min(ylimits[0], (min(cummul_error)/50-1)*50)
-            #ylimits[1] = max(ylimits[1], (max(cummul_error)/50+1)*50)
-            avg_error = sum(cummul_error) / len(cummul_error)
-            #avg_error = np.mean(cummul_error)
-            #avg_error = np.median(cummul_error)
-
-            ylimits = [min(cummul_error), max(cummul_error)]
-            ylimits[0] = min(ylimits[0], Plot.ylimits_max[0])
-            ylimits[1] = max(ylimits[1], Plot.ylimits_max[1])
-            Plot.ylimits_max[0] = min(ylimits[0], Plot.ylimits_max[0])
-            Plot.ylimits_max[1] = max(ylimits[1], Plot.ylimits_max[1])
+            ylimits = list(ylimits_max)
             ylimits[0] = min(ylimits[0], 0, -abs(ylimits[1]))
             ylimits[1] = max(ylimits[1], 0, abs(ylimits[0]))
             if ylimits[0] == ylimits[1]:
@@ -128,8 +211,8 @@ class Plot:
                 ylimits[1] = .01
 
             if Plot.zoom_plot_fe_max:
-                ylimits[0] = min(ylimits[0], fe_lims['-fe limit'])
-                ylimits[1] = max(ylimits[1], fe_lims['+fe limit'])
+                ylimits[0] = min(ylimits[0], self.fe_lims['-fe limit'])
+                ylimits[1] = max(ylimits[1], self.fe_lims['+fe limit'])
 
             #line_error.set_xdata(range(len(error)))
             #line_error.set_ydata(error)
@@ -137,89 +220,214 @@ class Plot:
 
             if cummul_error_x == []:
                 self.line_error.set_data(range(len(cummul_error)), cummul_error)
-                Plot.ax.set_xlim(0, len(cummul_error))
+                self.ax.set_xlim(0, len(cummul_error))
             else:
                 cummul_error_x2 = np.asarray(cummul_error_x)
                 cummul_error_x2 -= cummul_error_x2[0]
 
-                self.line_error.set_data(cummul_error_x2, cummul_error)
+                # a copy, the buffers are trimmed in place
+                self.line_error.set_data(cummul_error_x2, np.array(cummul_error))
 
                 #dat = np.vstack((cummul_error_x2, cummul_error)).T
                 #print dat.shape, cummul_error_x[-1] - cummul_error_x[0], cummul_error_x2[0], cummul_error_x2[-1]
                 #sct_error.set_offsets(dat)
 
-                Plot.ax.set_xlim(cummul_error_x2[0], cummul_error_x2[-1])
+                self.ax.set_xlim(cummul_error_x2[0], cummul_error_x2[-1])
 
-            self.line_min.set_data(self.line_min.get_data()[0], [Plot.ylimits_max[0]] * 2)
-            self.line_max.set_data(self.line_min.get_data()[0], [Plot.ylimits_max[1]] * 2)
+            self.line_min.set_data(self.line_min.get_data()[0], [ylimits_max[0]] * 2)
+            self.line_max.set_data(self.line_min.get_data()[0], [ylimits_max[1]] * 2)
             self.line_avg.set_data(self.line_avg.get_data()[0], [avg_error] * 2)
             #fig.canvas.draw()
-            Plot.ax.set_ylim(ylimits[0] * 1.05, ylimits[1] * 1.05)
+            self.ax.set_ylim(ylimits[0] * 1.05, ylimits[1] * 1.05)
 
-            for obj, v in zip([self.text_min, self.text_max, self.text_avg], [Plot.ylimits_max[0], Plot.ylimits_max[1], avg_error]):
+            for obj, v in zip([self.text_min, self.text_max, self.text_avg], [ylimits_max[0], ylimits_max[1], avg_error]):
                 obj.set_y(v)
                 obj.set_text('{0:.3f} mm'.format(v))
 
+            # only an axis of its own, as with a Dashboard, has a title to show the coverage in
+            if coverage is not None and self.ax is not Plot.ax:
+                self.ax.set_title('{0}, {1!r}'.format(self.name, coverage))
+
             #time.sleep(0.05)
             #plt.pause(0.0001)
-            plt.pause(0.001)
+            if draw:
+                plt.pause(0.001)
+
+
+class Dashboard:
+    # one subplot per axis, and a single redraw per frame for all of them
+    # a frame is drawn once every axis has a new block, or frame_timeout seconds after the first
+    # pending update, but never more often than max_fps
+
+    def __init__(self, names, layout=None, max_fps=10., frame_timeout=.5):
+        self.names = sorted(names)
+        self.max_fps = max_fps
+        self.frame_timeout = frame_timeout
+
+        # rows, columns of the axes, the spectrum, if shown, is to the right of each axis
+        rows, cols = layout or (len(self.names), 1)
+        n_cols = cols * 2 if show_spectrum else cols
+
+        self.fig = plt.figure()
+        self.fig.canvas.set_window_title('Following-error')
+        self.plots = {}
+        for i, k in enumerate(self.names):
+            r, c = i // cols, i % cols
+            if show_spectrum:
+                ax = self.fig.add_subplot(rows, n_cols, r * n_cols + 2 * c + 1)
+                ax_psd = self.fig.add_subplot(rows, n_cols, r * n_cols + 2 * c + 2)
+                ax_psd.set_xlabel('frequency (Hz)')
+                ax_psd.set_ylabel('psd (mm^2/Hz)')
+                ax_psd.set_yscale('log')
+            else:
+                ax = self.fig.add_subplot(rows, n_cols, r * n_cols + c + 1)
+                ax_psd = None
+            ax.set_title(k)
+            ax.set_xlabel('time (s)')
+            ax.set_ylabel(Plot.position_error_label)
+            self.plots[k] = Plot(ax, ax_psd)
 
+        self.pending = set()
+        self.t_pending = None
+        self.t_frame = 0.
 
-def main():
-    ess = {}
-    for k,v in serial_ports.items():
-        es = LeadshineEasyServo()
-        es.open_serial(v)
+        plt.ion()
+        plt.show()
 
-        if not es.send_introduction():
-            print 'main(): failed introduction', k
-            sys.exit(1)
 
-        ess[k] = {'drive': es, 'plot': None}
+    def update(self, k):
+        # note that plot k has new data, and redraw if a frame is due
+        if not self.pending:
+            self.t_pending = time.time()
+        self.pending.add(k)
+
+        ct = time.time()
+        if ct - self.t_frame < 1. / self.max_fps:
+            return
+        if len(self.pending) < len(self.names) and ct - self.t_pending < self.frame_timeout:
+            return
+
+        self.t_frame = ct
+        self.pending.clear()
+        plt.pause(0.001)
+
 
-    for k,es in ess.items():
-        es['drive'].read_parameters()
+def main():
+    if server_address is None:
+        # all drives are brought up at once
+        drives = open_drives(serial_ports)
+    else:
+        client = LeadshineClient(server_address)
+        drives = client.drives()
+
+    ess = {}
+    for k,es in drives.items():
+        ess[k] = {'drive': es, 'plot': None}
 
     if True:
         cummul_error = {}
         cummul_error_x = {}
-
-        Plot.setup_graph()
+        spectra = {}
+        stats = {}
+        recorders = {}
+        chains = {}
+        n_blocks = {}
+
+        if dashboard:
+            dash = Dashboard(ess.keys(), dashboard_layout, dashboard_max_fps)
+        else:
+            Plot.setup_graph()
         for k,es in ess.items():
-            es['plot'] = Plot()
+            es['plot'] = dash.plots[k] if dashboard else Plot()
             es['plot'].add_graph(k, es['drive'].fe_max * es['drive'].step_scale)
             es['drive'].scope_setup()
 
             cummul_error[k] = []
             cummul_error_x[k] = []
 
-        for k,es in ess.items():
-            es['drive'].scope_exec('begin')
+            spectra[k] = Spectrum(es['drive'].scope_duration / Plot.ns, Plot.ns)
+            stats[k] = WindowStats(last_x_sec, es['drive'].step_scale, es['drive'].fe_max)
+            n_blocks[k] = 0
+
+            if record_prefix is not None:
+                recorders[k] = Recorder(record_prefix, k, Plot.ns, step_scale=es['drive'].step_scale)
+
+            if filters.get(k):
+                chains[k] = FilterChain(filters[k], es['drive'].scope_duration / Plot.ns, filter_reset_gap)
+
+        if contour_axes is not None:
+            contour = Contour(contour_axes, drives[contour_axes[0]].scope_duration / Plot.ns)
+
+        if snapshot_prefix is not None:
+            trigger = Trigger(drives, snapshot_prefix, trigger_level, trigger_edge, True, trigger_pre_sec, trigger_post_sec, trigger_holdoff_sec)
+
+        if server_address is None:
+            acq = Acquisition(drives)
+        else:
+            acq = client
+        acq.start()
+
+        if metrics_address is not None:
+            leadshine_metrics.collectors.append(leadshine_metrics.axis_collector(acq.coverage, stats))
+            leadshine_metrics.start_server(metrics_address)
+
+        # time of the latest sample of any axis
+        t_newest = 0.
 
         while True:
-            for k,es in ess.items():
-                time.sleep(.001)
-                error, error_x = es['drive'].scope_exec('retrieve')
-                if error != []:
-                    cummul_error[k] += error
-                    cummul_error_x[k] += error_x
-
-                    # start next request while finishing up with the latest data
-                    es['drive'].scope_exec('begin')
-
-                    # remove data from the front of the buffers until only the last_x seconds remain
-                    # XXX this is the last_x seconds received vs. what was received within the last_x seconds
-                    # if no additional data is received, the array is not cleared out
-                    while cummul_error_x[k][-1] - cummul_error_x[k][0] > last_x_sec:
-                        cummul_error[k] = cummul_error[k][100:]
-                        cummul_error_x[k] = cummul_error_x[k][100:]
-
-                    # overlap the sampling with the updating of the graph
-                    t4.start()
-                    es['plot'].plot_error(cummul_error[k], cummul_error_x[k])
-                    t4.lap()
-
-                    #print k, cummul_error[k][:10], cummul_error_x[k][:10]
+            # the next request of the drive has begun, so the sampling overlaps with the rest of the loop
+            k, error, error_x = acq.next_block()
+            es = ess[k]
+
+            # the filter state carries over from the previous block, so there is no seam between them
+            smoothed = chains[k].update(error, acq.coverage[k].gap).tolist() if k in chains else error
+
+            # the drive was blind between the blocks, mark the gap so it is not drawn over
+            if cummul_error_x[k] and acq.coverage[k].gap > 0.:
+                cummul_error[k] += [np.nan]
+                cummul_error_x[k] += [(cummul_error_x[k][-1] + error_x[0]) / 2.]
+
+            cummul_error[k] += smoothed
+            cummul_error_x[k] += error_x
+
+            # remove data from the front of the buffers of all axes until only what was sampled
+            # within the last_x seconds remains, an axis that stops receiving data is cleared out
+            t_newest = max(t_newest, error_x[-1])
+            for j in cummul_error_x:
+                i = bisect.bisect_left(cummul_error_x[j], t_newest - last_x_sec)
+                if i:
+                    del cummul_error[j][:i]
+                    del cummul_error_x[j][:i]
+
+            if k in recorders:
+                recorders[k].add_block(error, error_x)
+
+            if snapshot_prefix is not None:
+                trigger.add_block(k, smoothed, error_x)
+
+            if contour_axes is not None:
+                # the filters lag, differently for each axis, and would distort the combined vector
+                contour.add_block(k, error, error_x)
+
+            stats[k].add(error, error_x[-1])
+            spectra[k].update(error)
+            n_blocks[k] += 1
+            if print_resonances and n_blocks[k] % resonance_report_blocks == 0:
+                print k, 'resonances:', spectra[k]
+            if print_coverage and n_blocks[k] % resonance_report_blocks == 0:
+                print k, acq.coverage[k], acq.poll_report(k)
+            if contour_axes is not None and k == contour_axes[0] and n_blocks[k] % resonance_report_blocks == 0:
+                print contour
+
+            # overlap the sampling with the updating of the graph
+            ct = time.time()
+            es['plot'].plot_spectrum(spectra[k])
+            es['plot'].plot_error(cummul_error[k], cummul_error_x[k], stats[k], not dashboard, acq.coverage[k])
+            if dashboard:
+                dash.update(k)
+            stage_seconds.observe(time.time() - ct, getattr(es['drive'], 'labels', (k, '')) + ('graph',))
+
+            #print k, cummul_error[k][:10], cummul_error_x[k][:10]
 
 if __name__ == "__main__":
     main()
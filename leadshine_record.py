@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Recording of the following-error with a multi-resolution index
+#
+# Blocks are appended to a raw file of fixed size records, one per block. Next to it, a pyramid of
+# summaries is built as the blocks arrive. A level 0 summary covers bucket samples, and each summary
+# of the next level covers fanout summaries of the level below. Each summary holds the time of its
+# first and last samples and the min, max, mean, and number of its samples.
+#
+# query() renders any time range at screen resolution by reading only the summaries of the finest
+# level with no more entries than pixels, and raw() reads the samples themselves when zoomed in.
+# Files are read with memmap, so only the touched part of a recording of many hours is loaded.
+#
+# Files, for a prefix and axis:
+#   prefix.axis.raw    raw_dtype records
+#   prefix.axis.idxN   summary_dtype records of level N
+#   prefix.axis.meta   json, the samples per block and the mm per encoder count of the drive
+
+
+import os
+import sys
+import json
+
+import numpy as np
+
+
+summary_dtype = np.dtype([('t0', '<f8'), ('t1', '<f8'), ('min', '<f4'), ('max', '<f4'), ('mean', '<f4'), ('count', '<u4')])
+
+
+def raw_dtype(ns=200):
+    return np.dtype([('t_start', '<f8'), ('t_end', '<f8'), ('error', '<f4', (ns,))])
+
+
+def combine(summaries):
+    # a single summary of consecutive summaries
+    rv = np.zeros(1, dtype=summary_dtype)
+    count = summaries['count'].sum()
+    rv['t0'] = summaries['t0'][0]
+    rv['t1'] = summaries['t1'][-1]
+    rv['min'] = summaries['min'].min()
+    rv['max'] = summaries['max'].max()
+    rv['mean'] = np.dot(summaries['mean'].astype(np.float64), summaries['count']) / max(count, 1)
+    rv['count'] = count
+    return rv
+
+
+class Recorder:
+    def __init__(self, prefix, axis, ns=200, bucket=25, fanout=8, n_levels=6, step_scale=None):
+        # step_scale, the mm per encoder count of the drive, is saved so the error can be converted back to counts
+        self.ns = ns
+        meta = {'ns': ns, 'step_scale': step_scale}
+        fn = '{0}.{1}.meta'.format(prefix, axis)
+        if os.path.exists(fn):
+            # blocks are appended, and one recording holds one scale
+            with open(fn) as f:
+                old = json.load(f)
+            if old != meta:
+                raise ValueError('Recorder(): {0} was recorded with {1}, not {2}'.format(fn, old, meta))
+        with open(fn, 'w') as f:
+            json.dump(meta, f)
+        # bucket must divide ns, so each block is a whole number of level 0 summaries
+        self.bucket = bucket
+        self.fanout = fanout
+
+        self.raw_dtype = raw_dtype(ns)
+        self.f_raw = open('{0}.{1}.raw'.format(prefix, axis), 'ab')
+        self.f_idx = [open('{0}.{1}.idx{2}'.format(prefix, axis, i), 'ab') for i in range(n_levels)]
+        # summaries of each level not yet combined into the level above
+        self.pending = [np.zeros(0, dtype=summary_dtype) for i in range(n_levels)]
+
+        # reused for every block
+        self.rec = np.zeros(1, dtype=self.raw_dtype)
+        self.summaries = np.zeros(ns // bucket, dtype=summary_dtype)
+        self.bucket_t = np.arange(0, ns, bucket)
+
+
+    def add_block(self, error, error_x):
+        self.rec['t_start'] = error_x[0]
+        self.rec['t_end'] = error_x[-1]
+        self.rec['error'] = error
+        self.rec.tofile(self.f_raw)
+
+        # level 0, vectorized over the buckets of the block
+        e = self.rec['error'][0].reshape(-1, self.bucket)
+        dt = (error_x[-1] - error_x[0]) / (self.ns - 1)
+        s = self.summaries
+        s['t0'] = error_x[0] + self.bucket_t * dt
+        s['t1'] = s['t0'] + (self.bucket - 1) * dt
+        s['min'] = e.min(axis=1)
+        s['max'] = e.max(axis=1)
+        s['mean'] = e.mean(axis=1)
+        s['count'] = self.bucket
+        self.add_summaries(0, s)
+
+        self.f_raw.flush()
+        for f in self.f_idx:
+            f.flush()
+
+
+    def add_summaries(self, level, s):
+        s.tofile(self.f_idx[level])
+        if level + 1 == len(self.f_idx):
+            return
+
+        p = np.concatenate((self.pending[level], s))
+        n = len(p) // self.fanout * self.fanout
+        if n:
+            up = np.concatenate([combine(p[i:i + self.fanout]) for i in range(0, n, self.fanout)])
+            self.add_summaries(level + 1, up)
+        self.pending[level] = p[n:]
+
+
+    def close(self):
+        self.f_raw.close()
+        for f in self.f_idx:
+            f.close()
+
+
+class Recording:
+    def __init__(self, prefix, axis, ns=200):
+        self.prefix = prefix
+        self.axis = axis
+
+        # recordings made before the meta file have the default ns and an unknown step_scale
+        self.ns = ns
+        self.step_scale = None
+        if os.path.exists(self.fn('meta')):
+            with open(self.fn('meta')) as f:
+                meta = json.load(f)
+            self.ns = meta['ns']
+            self.step_scale = meta['step_scale']
+        self.raw_dtype = raw_dtype(self.ns)
+
+        self.n_levels = 0
+        while os.path.exists(self.fn('idx{0}'.format(self.n_levels))):
+            self.n_levels += 1
+
+
+    def fn(self, ext):
+        return '{0}.{1}.{2}'.format(self.prefix, self.axis, ext)
+
+
+    def open(self, ext, dtype):
+        # reopened on every query, the recording may still be growing
+        fn = self.fn(ext)
+        n = os.path.getsize(fn) // dtype.itemsize
+        if n == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(fn, dtype=dtype, mode='r', shape=(n,))
+
+
+    def level(self, i):
+        return self.open('idx{0}'.format(i), summary_dtype)
+
+
+    def time_range(self):
+        s = self.level(0)
+        if len(s) == 0:
+            return None, None
+        return s['t0'][0], s['t1'][-1]
+
+
+    def query(self, t0, t1, n_pixels):
+        # summaries covering [t0, t1] from the finest level with no more than n_pixels entries in the range
+        # the most recent summaries not yet combined into that level are taken from the levels below
+        levels = [self.level(i) for i in range(self.n_levels)]
+
+        i = 0
+        while i + 1 < self.n_levels:
+            s = levels[i]
+            n = np.searchsorted(s['t0'], t1, 'right') - np.searchsorted(s['t1'], t0, 'left')
+            if n <= n_pixels:
+                break
+            i += 1
+
+        rv = []
+        t_covered = t0
+        for j in range(i, -1, -1):
+            s = levels[j]
+            a = np.searchsorted(s['t1'], t_covered, 'left')
+            b = np.searchsorted(s['t0'], t1, 'right')
+            if j < i and len(rv) > 0 and a < len(s) and s['t0'][a] <= t_covered:
+                # skip the summary overlapping what the coarser level covers
+                a += 1
+            if a < b:
+                rv += [np.array(s[a:b])]
+                t_covered = s['t1'][b - 1]
+
+        if not rv:
+            return np.zeros(0, dtype=summary_dtype)
+        return np.concatenate(rv)
+
+
+    def raw(self, t0, t1):
+        # the samples within [t0, t1], as sample times and errors
+        r = self.open('raw', self.raw_dtype)
+        a = np.searchsorted(r['t_end'], t0, 'left')
+        b = np.searchsorted(r['t_start'], t1, 'right')
+        r = r[a:b]
+
+        ns = self.raw_dtype['error'].shape[0]
+        t = r['t_start'][:, None] + (r['t_end'] - r['t_start'])[:, None] * (np.arange(ns) / (ns - 1.))
+        t = t.ravel()
+        e = np.array(r['error']).ravel()
+        keep = (t >= t0) & (t <= t1)
+        return t[keep], e[keep]
+
+
+def view(prefix, axis, n_pixels=1000):
+    # min/max envelope and mean of a recording, re-rendered from the index as the view is zoomed
+    import matplotlib.pyplot as plt
+
+    rec = Recording(prefix, axis)
+    t_min, t_max = rec.time_range()
+    if t_min is None:
+        print 'view(): empty recording'
+        return
+
+    fig = plt.figure()
+    fig.canvas.set_window_title('Following-error ' + axis)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.set_xlabel('time (s)')
+    ax.set_ylabel('position error (mm)')
+    line_min, = ax.plot([], [], color='r')
+    line_max, = ax.plot([], [], color='r')
+    line_mean, = ax.plot([], [], color='g', marker='.', linestyle='')
+
+    def update(ax):
+        # the view is in seconds from the start of the recording
+        t0, t1 = ax.get_xlim()
+        t0 += t_min
+        t1 += t_min
+
+        s = rec.query(t0, t1, n_pixels)
+        if len(s) > 0 and s['count'].sum() > n_pixels:
+            t = (s['t0'] + s['t1']) / 2. - t_min
+            line_min.set_data(t, s['min'])
+            line_max.set_data(t, s['max'])
+            line_mean.set_data(t, s['mean'])
+        else:
+            # zoomed in to fewer samples than pixels
+            t, e = rec.raw(t0, t1)
+            line_min.set_data([], [])
+            line_max.set_data([], [])
+            line_mean.set_data(t - t_min, e)
+        fig.canvas.draw_idle()
+
+    s = rec.query(t_min, t_max, n_pixels)
+    ax.set_xlim(0, t_max - t_min)
+    ax.set_ylim(s['min'].min() * 1.05, s['max'].max() * 1.05)
+    ax.callbacks.connect('xlim_changed', update)
+    update(ax)
+    plt.show()
+
+
+def main():
+    if len(sys.argv) != 3:
+        print 'usage:', sys.argv[0], 'prefix axis'
+        sys.exit(1)
+
+    view(sys.argv[1], sys.argv[2])
+
+
+if __name__ == "__main__":
+    main()
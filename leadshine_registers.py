@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Register map of the ES-D508 as observed with a serial sniffer while running the ProTuner software.
+#
+# Every request frame that does not depend on a runtime value is compiled once, including its
+# crc, and reused for every transaction. The map also drives range validation of writes and
+# coalescing of reads of contiguous registers into a single request.
+
+
+import numbers
+import struct
+from itertools import islice
+
+
+slave_address = 0x01
+
+fc_read = 0x03
+fc_write = 0x06
+fc_write_multiple = 0x10
+
+# the drive answers a request it does not support with the function code or'ed with 0x80
+fc_exception = 0x80
+
+function_names = {fc_read: 'read', fc_write: 'write', fc_write_multiple: 'write multiple'}
+
+# slave, function code, register address, register count or value
+request_header = struct.Struct('>BBHH')
+
+# largest number of registers read in one request, the scope readout of 200 words is the largest seen
+max_read_count = 0xc8
+
+# largest number of registers written in one request, the modbus limit
+max_write_count = 0x7b
+
+
+def _crc_table():
+    table = []
+    for c in range(256):
+        crc = c
+        for i in range(8):
+            if (crc & 0x00001):
+                crc >>= 1
+                crc ^= 0xa001
+            else:
+                crc >>= 1
+        table += [crc]
+    return table
+
+crc_table = _crc_table()
+
+
+def crc_value(buf, start, end):
+    # crc of buf[start:end], buf is a bytearray and is not copied
+    crc = 0xffff
+
+    # table driven, one lookup per byte rather than eight shifts
+    for c in islice(buf, start, end):
+        crc = (crc >> 8) ^ crc_table[(crc ^ c) & 0xff]
+
+    return crc
+
+
+def modbus_crc(dat):
+    crc = crc_value(bytearray(dat), 0, len(dat))
+
+    crc = bytearray([0x00ff & crc, (0xff00 & crc) >> 8])
+    return crc
+
+
+def crc_matches(buf, n):
+    # whether the first n bytes of buf, a bytearray, are followed by their crc, checked in place
+    crc = crc_value(buf, 0, n)
+    return buf[n] == 0x00ff & crc and buf[n + 1] == (0xff00 & crc) >> 8
+
+
+# cache of compiled frames, keyed by the request without crc
+frame_cache = {}
+
+
+def compile_frame(cmd):
+    # cmd is a request without crc, e.g. [0x01, 0x03, 0x00, 0xFD, 0x00, 0x01]
+    key = tuple(cmd)
+    frame = frame_cache.get(key)
+    if frame is None:
+        frame = bytearray(cmd)
+        frame += modbus_crc(frame)
+        frame = bytes(frame)
+        frame_cache[key] = frame
+    return frame
+
+
+def readdress_frame(frame, slave):
+    # the same request sent to another slave
+    slave0, ct, address, n = request_header.unpack_from(frame)
+    if slave0 == slave:
+        return frame
+    return compile_frame([slave] + list(bytearray(frame[1:-2])))
+
+
+def read_frame(address, count=1, slave=slave_address):
+    return compile_frame(request_header.pack(slave, fc_read, address, count))
+
+
+def write_frame(address, v, slave=slave_address):
+    return compile_frame(request_header.pack(slave, fc_write, address, v & 0xffff))
+
+
+def write_multiple_frame(address, values, slave=slave_address):
+    # values vary from call to call, so these frames are not cached
+    n = len(values)
+    frame = bytearray(request_header.pack(slave, fc_write_multiple, address, n))
+    frame += struct.pack('>B{0}H'.format(n), 2 * n, *[v & 0xffff for v in values])
+    frame += modbus_crc(frame)
+    return bytes(frame)
+
+
+def parse_frame(frame):
+    # returns slave, function code, address, and count or value of a compiled request
+    return request_header.unpack_from(frame)
+
+
+def expected_response_len(frame):
+    slave, ct, address, n = parse_frame(frame)
+    if ct == fc_read:
+        # slave, function code, byte count, two bytes per register, crc
+        return 3 + 2 * n + 2
+    if ct == fc_write:
+        # the request is echoed
+        return 8
+    if ct == fc_write_multiple:
+        # slave, function code, address, and count
+        return 8
+    return -1
+
+
+class Register:
+    def __init__(self, name, address, default, rng, signed=False, writable=True, choices=None, idempotent=True, readback=False, latency=0.):
+        self.name = name
+        self.address = address
+        self.default = default
+        self.rng = rng
+        self.signed = signed
+        self.writable = writable
+        # optional mapping of raw values to descriptions
+        self.choices = choices
+
+        # a write that starts something, e.g. the scope or a test, must not be sent again when its response is lost,
+        # it is confirmed by reading back the register if readback, and otherwise fails
+        self.idempotent = idempotent
+        self.readback = readback
+        # seconds the drive may take to answer a write, beyond the usual latency
+        self.latency = latency
+
+        # read of the register alone, when the read of a run of registers fails
+        self.read_frame = read_frame(address)
+
+
+    def __repr__(self):
+        return 'Register({0!r}, 0x{1:02X})'.format(self.name, self.address)
+
+
+    def decode(self, dat, offset=0):
+        v = (dat[offset] << 8) | dat[offset + 1]
+        if self.signed and v & 0x8000:
+            v -= 0x10000
+        return v
+
+
+    def describe(self, v):
+        if self.choices and v in self.choices:
+            return self.choices[v]
+        return v
+
+
+    def validate(self, v):
+        if not self.writable:
+            raise ValueError('{0} is read-only'.format(self.name))
+        # a register holds a word, a float such as 2100.5 would fail only once the frame is built
+        if not isinstance(v, numbers.Integral) or isinstance(v, bool):
+            raise ValueError('{0}: {1!r} is not an integer'.format(self.name, v))
+        if self.rng is not None and not (self.rng[0] <= v <= self.rng[1]):
+            raise ValueError('{0}: {1} outside of range [{2}, {3}]'.format(self.name, v, self.rng[0], self.rng[1]))
+        return v
+
+
+# combined registers seen on parameters, motor settings, and inputs/outputs screens
+parameter_registers = [
+  #         name                                address default  range
+  Register('current loop kp',                    0x00,   641,   [0, 32766]),
+  Register('current loop ki',                    0x01,   291,   [0, 32766]),
+  Register('pulses / revolution',                0x0E,  4000, [200, 51200]),
+  Register('encoder resolution (ppr)',           0x0F,  4000, [200, 51200]),
+  Register('position error limit (pulses)',      0x12,  1000,   [0, 65535]),
+  Register('position loop kp',                   0x06,  2000,   [0, 32767]),
+  Register('position loop ki',                   0x07,   500,   [0, 32767]),
+  Register('position loop kd',                   0x08,   200,   [0, 32767]),
+  Register('position loop kvff',                 0x0D,    30,   [0, 32767]),
+  Register('holding current (%)',                0x50,    40,     [0, 100]),
+  Register('open-loop current (%)',              0x51,    50,     [0, 100]),
+  Register('closed-loop current (%)',            0x52,   100,     [0, 100]),
+  Register('anti-interference time',             0x53,  1000,    [0, 1000]),
+  Register('enable control',                     0x96,     1,       [0, 1], choices={0: 'high level', 1: 'low level'}),
+  Register('fault output',                       0x97,     0,       [0, 1], choices={0: 'active high', 1: 'active low'}),
+  Register('filtering enable',                   0x54,     0,       [0, 1], choices={0: 'disabled', 1: 'enabled'}),
+  Register('filtering time (us)',                0x55, 25600,  [50, 25600]),
+  Register('reserved (pulse mode)?',             0x4F,     0,       [0, 1]), # reported value = 0
+  Register('pulse active edge',                  0xFF,     4,       [4, 6], choices={4: 'rising', 6: 'falling'}),
+  Register('reserved (direction)?',              0xFD,   130,         None, writable=False), # reported value = 130, also the introduction
+  Register('reserved (bandwidth)?',              0x90,     1,       [0, 1]), # reported value = 1
+  Register('current loop auto-configuration?',   0x40,     1,       [0, 1]),
+]
+
+# motion test screen
+motion_registers = [
+  Register('acceleration (r/s/s)',               0x15,  2000,   [0, 32767]),
+  Register('velocity (rpm)',                     0x16,    60,   [0, 32767]),
+  Register('trace time?',                        0x18,   100,   [0, 32767]),
+  Register('distance?',                          0x19,     1,   [0, 32767]),
+  Register('motion direction?',                  0x1A,     1,       [0, 1]),
+  Register('intermission (ms)?',                 0x1B,   100,   [0, 32767]),
+  Register('motion mode?',                       0x1C,     1,       [0, 1]),
+  Register('motion test start',                  0x09,  None,       [0, 1], idempotent=False),
+]
+
+other_registers = [
+  # current test
+  Register('current test step',                  0x04,  None,   [0, 32767]),
+  # answered ~95 ms after the request, and reads 1 until the test is stopped by writing 0
+  Register('current test start',                 0x02,  None,       [0, 1], idempotent=False, readback=True, latency=.15),
+
+  # scope
+  # reading 0x14 returns the samples, so a write cannot be read back
+  Register('scope trigger',                      0x14,  None,       [0, 1], idempotent=False),
+  Register('scope status',                       0xDA,  None,         None, writable=False), # 2 = samples ready
+  Register('scope duration (10ms)',              0xD0,    20,     [1, 300]),
+  Register('scope channel',                      0x41,     1,       [0, 8]), # 1 = position error, 8 = current
+  Register('scope setup3',                       0x42,     0,       [0, 1]),
+
+  # alarms
+  Register('alarm',                              0x10,  None,         None, writable=False),
+]
+
+registers = parameter_registers + motion_registers + other_registers
+
+register_map = dict((r.name, r) for r in registers)
+register_addresses = dict((r.address, r) for r in registers)
+
+
+def write_hazard(frame):
+    # the registers written by frame that must not be written twice, and the seconds the drive may take to answer
+    # beyond the usual latency, ([], 0.) for a read
+    slave, ct, address, n = parse_frame(frame)
+    if ct == fc_write:
+        regs = [register_addresses.get(address)]
+    elif ct == fc_write_multiple:
+        regs = [register_addresses.get(a) for a in range(address, address + n)]
+    else:
+        return [], 0.
+    regs = [r for r in regs if r is not None]
+    return [r for r in regs if not r.idempotent], max([r.latency for r in regs] + [0.])
+
+
+def compile_reads(names, max_count=max_read_count):
+    # group the named registers into runs of contiguous addresses, one read request per run
+    regs = sorted([register_map[k] for k in names], key=lambda r: r.address)
+
+    runs = []
+    for r in regs:
+        if runs and r.address == runs[-1][-1].address + 1 and len(runs[-1]) < max_count:
+            runs[-1] += [r]
+        else:
+            runs += [[r]]
+
+    return [(read_frame(run[0].address, len(run)), run) for run in runs]
+
+
+def compile_writes(values, max_count=max_write_count):
+    # values maps register names to new values
+    # every value is validated before anything is sent, then grouped into runs of contiguous registers
+    regs = sorted([register_map[k] for k in values], key=lambda r: r.address)
+    for r in regs:
+        r.validate(values[r.name])
+
+    runs = []
+    for r in regs:
+        if runs and r.address == runs[-1][-1].address + 1 and len(runs[-1]) < max_count:
+            runs[-1] += [r]
+        else:
+            runs += [[r]]
+
+    return [(run[0].address, [values[r.name] for r in run], run) for run in runs]
+
+
+parameter_names = [r.name for r in parameter_registers]
+parameter_reads = compile_reads(parameter_names)
+
+motion_names = [r.name for r in motion_registers if r.default is not None]
+motion_reads = compile_reads(motion_names)
+
+
+# alarms, register 0x10 holds the active alarm word and the following nine the words of earlier alarms
+# only position following error (0x0020) has been seen as the active alarm; 0x0002 appears in the
+# history, its meaning is unknown, and bits not listed here are reported by number
+alarm_bits = {
+  0x0020: 'position following error',
+}
+
+alarm_history_len = 9
+
+alarm_read = read_frame(0x10)
+alarm_history_read = read_frame(0x10, 1 + alarm_history_len)
+
+
+def decode_alarm(word):
+    # names of the alarms set in an alarm word, one per bit
+    return [alarm_bits.get(1 << i, 'alarm bit {0}'.format(i)) for i in range(16) if word & (1 << i)]
+
+
+def alarm_events(old, new):
+    # ('raised' or 'cleared', name) for each bit that differs between two alarm words
+    # old is None before the first reading, then every active alarm is reported as raised
+    if old is None:
+        old = 0
+    rv = []
+    for i in range(16):
+        bit = 1 << i
+        if (old ^ new) & bit:
+            rv += [('raised' if new & bit else 'cleared', decode_alarm(bit)[0])]
+    return rv
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Fan-out of the following-error of the drives to any number of local subscribers
+#
+# A serial port can only be opened by one process. The server owns the drives, runs the
+# acquisition, and publishes each block to every subscriber over TCP or a Unix socket.
+# Each subscriber has its own bounded queue and sending thread, so a slow subscriber drops
+# blocks, by its drop policy, rather than stalling the acquisition or the other subscribers.
+#
+# LeadshineClient has the interface of Acquisition, start() and next_block(), and drives()
+# provides stand-ins for the drives with the parameters the plot needs.
+#
+# Framing, little endian:
+#   header: magic 'LS', message type, length of axis name, length of payload  ('<2sBBI')
+#   axis name
+#   payload
+#     info:  step scale (mm/step), following-error limit (steps), scope duration (s)  ('<dId')
+#     block: time of first and last samples, then the samples as int16 steps          ('<dd' + int16)
+
+
+import collections
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+from leadshine_easyservo import *
+from leadshine_acquire import *
+import leadshine_metrics
+
+
+serial_ports = {'x-axis': '/dev/ttyUSB0',
+                'y-axis': '/dev/ttyUSB1',
+                'z-axis': '/dev/ttyUSB2'}
+
+# a (host, port) tuple for TCP, or a path for a Unix socket
+listen_addresses = [('localhost', 5555), '/tmp/leadshine.sock']
+
+# blocks queued per subscriber before dropping, at 200ms per block 50 blocks is ten seconds
+queue_len = 50
+
+# 'oldest' drops the oldest queued block, 'newest' drops the arriving block, 'disconnect' drops the subscriber
+drop_policy = 'oldest'
+
+# serve counters and latency histograms of the drives and the coverage of each axis, see leadshine_metrics
+metrics_address = ('127.0.0.1', 9108)
+
+
+header_fmt = struct.Struct('<2sBBI')
+info_fmt = struct.Struct('<dId')
+block_fmt = struct.Struct('<dd')
+
+magic = b'LS'
+msg_info = 1
+msg_block = 2
+
+
+def encode_info(axis, step_scale, fe_max, scope_duration):
+    payload = info_fmt.pack(step_scale, fe_max, scope_duration)
+    return header_fmt.pack(magic, msg_info, len(axis), len(payload)) + axis + payload
+
+
+def encode_block(axis, error, error_x, step_scale):
+    # the error is sent as integer steps, as read from the drive, and the sample times as the first and last
+    steps = np.rint(np.asarray(error) / step_scale).astype('<i2')
+    payload = block_fmt.pack(error_x[0], error_x[-1]) + steps.tostring()
+    return header_fmt.pack(magic, msg_block, len(axis), len(payload)) + axis + payload
+
+
+def open_socket(address):
+    if isinstance(address, tuple):
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+
+class Subscriber:
+    def __init__(self, sock, name, policy=drop_policy, n=queue_len):
+        self.sock = sock
+        self.name = name
+        self.policy = policy
+        self.n = n
+
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.connected = True
+        self.n_sent = 0
+        self.n_dropped = 0
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def put(self, msg):
+        # never blocks
+        with self.cond:
+            if len(self.queue) >= self.n:
+                self.n_dropped += 1
+                if self.policy == 'newest':
+                    return
+                elif self.policy == 'disconnect':
+                    self.connected = False
+                    self.cond.notify()
+                    return
+                self.queue.popleft()
+            self.queue.append(msg)
+            self.cond.notify()
+
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.connected and not self.queue:
+                    self.cond.wait()
+                if not self.connected:
+                    break
+                msg = self.queue.popleft()
+
+            try:
+                self.sock.sendall(msg)
+                self.n_sent += 1
+            except socket.error:
+                break
+
+        self.connected = False
+        self.sock.close()
+        print 'Subscriber disconnected', self.name, 'sent:', self.n_sent, 'dropped:', self.n_dropped
+
+
+class Publisher:
+    def __init__(self, addresses=listen_addresses):
+        self.subscribers = []
+        self.lock = threading.Lock()
+        # axis -> info message, sent to every new subscriber
+        self.info = collections.OrderedDict()
+
+        for address in addresses:
+            sock = open_socket(address)
+            if isinstance(address, tuple):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            elif os.path.exists(address):
+                os.unlink(address)
+            sock.bind(address)
+            sock.listen(5)
+
+            th = threading.Thread(target=self.accept, args=(sock, address))
+            th.daemon = True
+            th.start()
+
+
+    def accept(self, sock, address):
+        while True:
+            conn, peer = sock.accept()
+            if isinstance(address, tuple):
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sub = Subscriber(conn, peer or address)
+            with self.lock:
+                for msg in self.info.values():
+                    sub.put(msg)
+                self.subscribers += [sub]
+            print 'Subscriber connected', sub.name
+
+
+    def add_axis(self, axis, step_scale, fe_max, scope_duration):
+        with self.lock:
+            self.info[axis] = encode_info(axis, step_scale, fe_max, scope_duration)
+
+
+    def publish(self, axis, error, error_x, step_scale):
+        # the block is encoded once for all subscribers
+        msg = encode_block(axis, error, error_x, step_scale)
+        with self.lock:
+            self.subscribers = [sub for sub in self.subscribers if sub.connected]
+            for sub in self.subscribers:
+                sub.put(msg)
+
+
+class RemoteDrive:
+    # stands in for a LeadshineEasyServo on the client side, the drive itself is configured by the server
+    def __init__(self, step_scale, fe_max, scope_duration):
+        self.step_scale = step_scale
+        self.fe_max = fe_max
+        self.scope_duration = scope_duration
+
+
+    def scope_setup(self):
+        pass
+
+
+class LeadshineClient:
+    def __init__(self, address=listen_addresses[0]):
+        self.sock = open_socket(address)
+        self.sock.connect(address)
+        self.remote_drives = {}
+        self.pending = collections.deque()
+        # name -> Coverage, as with Acquisition
+        self.coverage = collections.defaultdict(Coverage)
+
+
+    def recv(self, n):
+        v = b''
+        while len(v) < n:
+            b = self.sock.recv(n - len(v))
+            if not b:
+                raise EOFError('server closed the connection')
+            v += b
+        return v
+
+
+    def read_message(self):
+        m, ct, name_len, payload_len = header_fmt.unpack(self.recv(header_fmt.size))
+        if m != magic:
+            raise IOError('read_message(): lost framing')
+        axis = self.recv(name_len)
+        payload = self.recv(payload_len)
+
+        if ct == msg_info:
+            self.remote_drives[axis] = RemoteDrive(*info_fmt.unpack(payload))
+            return None
+
+        if ct == msg_block:
+            t_s, t_e = block_fmt.unpack_from(payload)
+            steps = np.frombuffer(payload, dtype='<i2', offset=block_fmt.size)
+            d = self.remote_drives[axis]
+            error = list(steps * d.step_scale)
+            error_x = list(np.linspace(t_s, t_e, num=len(steps), endpoint=True))
+            return axis, error, error_x
+
+        return None
+
+
+    def drives(self, timeout=2.):
+        # stand-ins of the drives published by the server, the server sends these first
+        t_end = time.time() + timeout
+        while time.time() < t_end:
+            self.sock.settimeout(max(t_end - time.time(), .001))
+            try:
+                rv = self.read_message()
+            except socket.timeout:
+                break
+            finally:
+                self.sock.settimeout(None)
+            if rv is not None:
+                # a block arrived, all info messages have been seen
+                self.pending.append(rv)
+                break
+        return dict(self.remote_drives)
+
+
+    def start(self):
+        pass
+
+
+    def poll_report(self, k):
+        # the background polls are run by the server, and are reported there
+        return ''
+
+
+    def next_block(self):
+        if self.pending:
+            rv = self.pending.popleft()
+        else:
+            rv = None
+            while rv is None:
+                rv = self.read_message()
+
+        axis, error, error_x = rv
+        self.coverage[axis].add(error_x[0], self.remote_drives[axis].scope_duration)
+        return rv
+
+
+def main():
+    ess = open_drives(serial_ports)
+
+    pub = Publisher(listen_addresses)
+    for k, es in ess.items():
+        es.scope_setup()
+        pub.add_axis(k, es.step_scale, es.fe_max, es.scope_duration)
+
+    acq = Acquisition(ess)
+    acq.start()
+
+    if metrics_address is not None:
+        leadshine_metrics.collectors.append(leadshine_metrics.axis_collector(acq.coverage))
+        leadshine_metrics.start_server(metrics_address)
+
+    while True:
+        k, error, error_x = acq.next_block()
+        pub.publish(k, error, error_x, ess[k].step_scale)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Offline decoder of serial sniffer captures
+#
+# The capture is a text log with one line per frame, as quoted in read_alarms(), e.g.
+#   Frame000 TX 540022464: 1 3 0 10 0 A C4 8
+#   Frame000 RX 540025004: 1 3 14 0 20 0 20 0 2 0 20 0 0 0 0 0 0 0 0 0 0 0 0 CC B
+# TX lines are requests to the drive and RX lines are responses. Timestamps are the sniffer's ticks.
+#
+# The log is split into chunks at line boundaries and the chunks are parsed by a pool of processes,
+# each splitting lines holding pipelined frames and checking the crc of all frames of the same
+# length at once. The parent pairs requests with responses in order, labels each register read
+# or written against the register map, and alarm words by their alarms, and writes:
+#   prefix-history.csv   every register access, ordered by slave, register, and time
+#   prefix-summary.csv   per register, the number of reads and writes, the values seen, and latency
+
+
+import collections
+import csv
+import multiprocessing
+import os
+import re
+import sys
+
+import numpy as np
+
+from leadshine_registers import *
+
+
+line_re = re.compile(r'Frame\d+\s+(TX|RX)\s+(\d+):\s*([0-9A-Fa-f ]+)')
+
+# registers by address, for labeling
+address_map = dict((r.address, r) for r in registers)
+
+crc_table_u16 = np.array(crc_table, dtype=np.uint16)
+
+# a read of this many registers from the scope trigger is the scope readout, summarized as one access
+scope_readout = (0x14, 0xc8)
+
+# a read of the alarm register, alone or with the history that follows it, holds alarm words, not the registers after it
+alarm_address = 0x10
+alarm_reads = [(alarm_address, 1), (alarm_address, 1 + alarm_history_len)]
+
+
+def crc_bulk(frames):
+    # frames is an (n, length) uint8 array of frames of the same length, returns whether each crc matches
+    crc = np.empty(len(frames), dtype=np.uint16)
+    crc.fill(0xffff)
+    for i in range(frames.shape[1] - 2):
+        crc = (crc >> 8) ^ crc_table_u16[(crc ^ frames[:, i]) & 0xff]
+    return (frames[:, -2] == (crc & 0xff)) & (frames[:, -1] == (crc >> 8))
+
+
+def frame_len(b, i, is_request):
+    # length of the frame at b[i:], from its function code, or -1 if unknown
+    if len(b) - i < 2:
+        return -1
+    ct = b[i + 1]
+    if ct & fc_exception:
+        return 5
+    if is_request:
+        if ct == fc_read or ct == fc_write:
+            return 8
+        if ct == fc_write_multiple and len(b) - i >= 7:
+            return 7 + b[i + 6] + 2
+    else:
+        if ct == fc_read:
+            # read responses are never pipelined, and the byte count is not reliable for the scope
+            # readout, see read_response_into(), so the remainder of the line is the frame
+            return len(b) - i
+        if ct == fc_write or ct == fc_write_multiple:
+            return 8
+    return -1
+
+
+def split_frames(b, is_request):
+    # a line may hold several pipelined frames
+    rv = []
+    i = 0
+    while i < len(b):
+        n = frame_len(b, i, is_request)
+        if n == -1:
+            n = len(b) - i
+        rv += [bytes(b[i:i + n])]
+        i += n
+    return rv
+
+
+def parse_chunk(args):
+    # parse the lines starting within [start, end) of the log, returns (is_request, tick, frame, crc ok) lists
+    fn, start, end = args
+
+    is_request = []
+    ticks = []
+    frames = []
+
+    with open(fn, 'rb') as f:
+        if start:
+            # the line straddling start belongs to the previous chunk
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            m = line_re.search(line)
+            if m is None:
+                continue
+            b = bytearray(int(v, 16) for v in m.group(3).split())
+            for frame in split_frames(b, m.group(1) == 'TX'):
+                is_request += [m.group(1) == 'TX']
+                ticks += [int(m.group(2))]
+                frames += [frame]
+
+    # check the crc of all frames of the same length at once
+    crc_ok = np.zeros(len(frames), dtype=bool)
+    lengths = np.array([len(v) for v in frames])
+    for n in np.unique(lengths):
+        idx = np.flatnonzero(lengths == n)
+        if n < 4:
+            continue
+        a = np.frombuffer(b''.join(frames[i] for i in idx), dtype=np.uint8).reshape(-1, n)
+        crc_ok[idx] = crc_bulk(a)
+
+    return is_request, ticks, frames, list(crc_ok)
+
+
+def chunks(fn, chunk_size=1 << 22):
+    size = os.path.getsize(fn)
+    return [(fn, i, min(i + chunk_size, size)) for i in range(0, size, chunk_size)]
+
+
+def register_name(address):
+    if address in address_map:
+        return address_map[address].name
+    return 'unknown 0x{0:02X}'.format(address)
+
+
+def matches(request, response):
+    # whether response answers request, writes are echoed
+    a = bytearray(request)
+    b = bytearray(response)
+    if a[0] != b[0] or a[1] != b[1] & ~fc_exception & 0xff:
+        return False
+    if b[1] == fc_write:
+        return a == b
+    if b[1] == fc_write_multiple:
+        return a[:6] == b[:6]
+    return True
+
+
+def alarm_label(word):
+    # an alarm word and the names of its alarms, see decode_alarm()
+    return ' '.join(['0x{0:04X}'.format(word)] + decode_alarm(word))
+
+
+def label(request, response):
+    # (access, address, value) of each register in a request and its response
+    # value is signed if the register is, None for the scope readout, and an alarm_label() for alarm words
+    slave, ct, address, n = request_header.unpack_from(request)
+    if response is not None and bytearray(response)[1] & fc_exception:
+        return [('exception {0}'.format(bytearray(response)[2]), address, None)]
+
+    if ct == fc_read:
+        if (address, n) == scope_readout:
+            return [('scope readout', address, None)]
+        if (address, n) in alarm_reads:
+            # the active alarm as a read of the alarm register, then the history, all labelled by the alarm register
+            if response is None:
+                return [('read', address, None)]
+            b = bytearray(response)
+            words = [(b[3 + 2 * i] << 8) | b[4 + 2 * i] for i in range(min(n, (len(b) - 5) // 2))]
+            return [('read' if i == 0 else 'alarm history {0}'.format(i), address, alarm_label(w)) for i, w in enumerate(words)]
+        if response is None:
+            return [('read', address + i, None) for i in range(n)]
+        b = bytearray(response)
+        rv = []
+        for i in range(min(n, (len(b) - 5) // 2)):
+            v = (b[3 + 2 * i] << 8) | b[4 + 2 * i]
+            r = address_map.get(address + i)
+            if r is not None:
+                v = r.decode(b, 3 + 2 * i)
+            rv += [('read', address + i, v)]
+        return rv
+
+    if ct == fc_write:
+        v = n
+        r = address_map.get(address)
+        if r is not None and r.signed and v & 0x8000:
+            v -= 0x10000
+        return [('write', address, v)]
+
+    if ct == fc_write_multiple:
+        b = bytearray(request)
+        return [('write', address + i, (b[7 + 2 * i] << 8) | b[8 + 2 * i]) for i in range(n)]
+
+    return []
+
+
+class Decoder:
+    def __init__(self):
+        # (slave, address) -> list of (tick request, tick response, access, value)
+        self.history = {}
+        # requests awaiting a response, in order, several when writes are pipelined
+        self.pending = collections.deque()
+
+        self.n_frames = 0
+        self.n_crc_failed = 0
+        self.n_unpaired = 0
+
+
+    def add(self, is_request, tick, frame, crc_ok):
+        self.n_frames += 1
+        if not crc_ok:
+            self.n_crc_failed += 1
+            return
+
+        if is_request:
+            # pipelined requests share a line, and so a tick, the host waits for the responses to
+            # one line before sending the next, so earlier requests still pending went unanswered
+            if self.pending and self.pending[-1][0] != tick:
+                self.flush()
+            self.pending.append((tick, frame))
+            return
+
+        # the response is to the oldest request it matches, the requests before it went unanswered
+        while self.pending:
+            request = self.pending.popleft()
+            if matches(request[1], frame):
+                self.record(request, (tick, frame))
+                return
+            self.record(request, None)
+        self.n_unpaired += 1
+
+
+    def flush(self):
+        while self.pending:
+            self.record(self.pending.popleft(), None)
+
+
+    def record(self, request, response):
+        if len(request[1]) < 8:
+            self.n_unpaired += 1
+            return
+        if response is None:
+            self.n_unpaired += 1
+
+        slave = bytearray(request[1])[0]
+        tick_rx = response[0] if response is not None else None
+        for access, address, v in label(request[1], response[1] if response is not None else None):
+            self.history.setdefault((slave, address), []).append((request[0], tick_rx, access, v))
+
+
+    def write(self, prefix):
+        with open(prefix + '-history.csv', 'wb') as f:
+            w = csv.writer(f)
+            w.writerow(['slave', 'address', 'name', 'access', 'value', 'tick request', 'tick response', 'latency'])
+            for (slave, address), h in sorted(self.history.items()):
+                name = register_name(address)
+                for t_tx, t_rx, access, v in h:
+                    latency = t_rx - t_tx if t_rx is not None else ''
+                    w.writerow([slave, '0x{0:02X}'.format(address), name, access, v, t_tx, t_rx, latency])
+
+        with open(prefix + '-summary.csv', 'wb') as f:
+            w = csv.writer(f)
+            w.writerow(['slave', 'address', 'name', 'reads', 'writes', 'values', 'first', 'last', 'min', 'max', 'mean latency'])
+            for (slave, address), h in sorted(self.history.items()):
+                values = [v for t_tx, t_rx, access, v in h if v is not None]
+                latency = [t_rx - t_tx for t_tx, t_rx, access, v in h if t_rx is not None]
+                w.writerow([slave, '0x{0:02X}'.format(address), register_name(address),
+                            sum(1 for v in h if v[2] in ('read', 'scope readout')), sum(1 for v in h if v[2] == 'write'),
+                            len(set(values)),
+                            values[0] if values else '', values[-1] if values else '',
+                            min(values) if values else '', max(values) if values else '',
+                            np.mean(latency) if latency else ''])
+
+
+def decode(fn, prefix, processes=None):
+    dec = Decoder()
+
+    pool = multiprocessing.Pool(processes)
+    # imap keeps the chunks in order, so requests and responses pair across chunk boundaries
+    for is_request, ticks, frames, crc_ok in pool.imap(parse_chunk, chunks(fn)):
+        for v in zip(is_request, ticks, frames, crc_ok):
+            dec.add(*v)
+    pool.close()
+    pool.join()
+
+    dec.flush()
+
+    dec.write(prefix)
+
+    print fn, dec.n_frames, 'frames,', dec.n_crc_failed, 'failed crc,', dec.n_unpaired, 'unpaired,', len(dec.history), 'registers'
+
+    return dec
+
+
+def main():
+    if len(sys.argv) not in [3, 4]:
+        print 'usage:', sys.argv[0], 'capture.log prefix [processes]'
+        sys.exit(1)
+
+    processes = int(sys.argv[3]) if len(sys.argv) == 4 else None
+    decode(sys.argv[1], sys.argv[2], processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Welch-style power spectral density of the following-error, updated as scope blocks arrive
+#
+# Each block of 200 samples is one segment. The samples within a block are evenly spaced at
+# scope_duration / 200, while the gap between blocks is not, so segments never span blocks and
+# the readout gaps do not matter. Segments are averaged, exponentially once n_avg blocks are seen,
+# so the estimate follows changes in the machine.
+
+
+import numpy as np
+
+
+class Spectrum:
+    def __init__(self, dt, ns=200, n_avg=32):
+        # dt is the sample period, i.e. scope_duration / ns
+        self.dt = dt
+        self.ns = ns
+        self.n_avg = n_avg
+
+        self.window = np.hanning(ns)
+        # scale to a one-sided density, (mm^2 / Hz)
+        self.scale = np.full(ns // 2 + 1, 2. * dt / np.sum(self.window ** 2))
+        self.scale[0] /= 2.
+        if ns % 2 == 0:
+            self.scale[-1] /= 2.
+
+        self.freq = np.fft.rfftfreq(ns, dt)
+
+        # reused between blocks
+        self.segment = np.empty(ns)
+        self.power = np.empty(len(self.freq))
+
+        self.psd = np.zeros(len(self.freq))
+        self.n = 0
+
+
+    def update(self, error):
+        # error is one block of ns samples
+        if len(error) != self.ns:
+            return
+
+        seg = self.segment
+        seg[:] = error
+        seg -= seg.mean()
+        seg *= self.window
+
+        np.abs(np.fft.rfft(seg), out=self.power)
+        self.power *= self.power
+        self.power *= self.scale
+
+        # running mean of the first n_avg blocks, and then an exponential average
+        self.n += 1
+        w = 1. / min(self.n, self.n_avg)
+        self.power -= self.psd
+        self.power *= w
+        self.psd += self.power
+
+
+    def peaks(self, n=3, f_min=10., ratio=10.):
+        # dominant resonances as a list of (frequency (Hz), psd) of the n largest local maxima
+        # above f_min, that rise at least ratio times above the median of the spectrum
+        if self.n == 0:
+            return []
+
+        p = self.psd
+        is_peak = np.zeros(len(p), dtype=bool)
+        is_peak[1:-1] = (p[1:-1] > p[:-2]) & (p[1:-1] >= p[2:])
+        is_peak &= self.freq >= f_min
+        is_peak &= p > ratio * np.median(p)
+
+        idx = np.nonzero(is_peak)[0]
+        idx = idx[np.argsort(p[idx])[::-1][:n]]
+
+        return [(self.freq[i], p[i]) for i in idx]
+
+
+    def __repr__(self):
+        return ' '.join(['{0:.0f} Hz ({1:.2e})'.format(f, v) for f, v in self.peaks()])
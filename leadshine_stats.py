@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Statistics of the following-error over a sliding window, updated a block at a time
+#
+# Blocks enter the window as they arrive and leave once older than the window. Each block is
+# summarized when it enters, so an update costs O(block) regardless of the length of the window.
+# The following-error is quantized to the encoder step, so values are kept as integer steps and
+# the running sums are exact, with no drift from subtracting blocks that leave.
+
+
+import collections
+
+import numpy as np
+
+
+class WindowStats:
+    def __init__(self, window_sec, step_scale, fe_max):
+        # step_scale converts steps to mm, fe_max is the following-error limit in steps
+        # the histogram used for percentiles covers +/- fe_max, values beyond are counted at the ends
+        self.window_sec = window_sec
+        self.step_scale = step_scale
+        self.fe_max = int(fe_max)
+
+        # (block id, end time, steps) of the blocks within the window
+        self.blocks = collections.deque()
+        self.block_id = 0
+
+        # block summaries in monotonic order, the front is the extreme of the window
+        # (block id, block minimum) increasing, and (block id, block maximum) decreasing
+        self.mins = collections.deque()
+        self.maxs = collections.deque()
+
+        self.n = 0
+        self.sum = 0
+        self.sumsq = 0
+        self.hist = np.zeros(2 * self.fe_max + 1, dtype=np.int64)
+
+        # all-time extremes of this axis (mm)
+        self.all_min = 0.
+        self.all_max = 0.
+
+
+    def add(self, error, t_end):
+        # error is a block in mm, t_end the time of its last sample
+        steps = np.rint(np.asarray(error) / self.step_scale).astype(np.int64)
+        if len(steps) == 0:
+            return
+
+        self.block_id += 1
+        self.blocks.append((self.block_id, t_end, steps))
+
+        self.n += len(steps)
+        self.sum += int(steps.sum())
+        self.sumsq += int(np.dot(steps, steps))
+        np.add.at(self.hist, np.clip(steps + self.fe_max, 0, 2 * self.fe_max), 1)
+
+        lo = int(steps.min())
+        hi = int(steps.max())
+        while self.mins and self.mins[-1][1] >= lo:
+            self.mins.pop()
+        self.mins.append((self.block_id, lo))
+        while self.maxs and self.maxs[-1][1] <= hi:
+            self.maxs.pop()
+        self.maxs.append((self.block_id, hi))
+
+        self.all_min = min(self.all_min, lo * self.step_scale)
+        self.all_max = max(self.all_max, hi * self.step_scale)
+
+        self.expire(t_end - self.window_sec)
+
+
+    def expire(self, t):
+        # remove the blocks that ended before t
+        while self.blocks and self.blocks[0][1] < t:
+            block_id, t_end, steps = self.blocks.popleft()
+
+            self.n -= len(steps)
+            self.sum -= int(steps.sum())
+            self.sumsq -= int(np.dot(steps, steps))
+            np.subtract.at(self.hist, np.clip(steps + self.fe_max, 0, 2 * self.fe_max), 1)
+
+            if self.mins and self.mins[0][0] == block_id:
+                self.mins.popleft()
+            if self.maxs and self.maxs[0][0] == block_id:
+                self.maxs.popleft()
+
+
+    def mean(self):
+        if self.n == 0:
+            return 0.
+        return float(self.sum) / self.n * self.step_scale
+
+
+    def rms(self):
+        if self.n == 0:
+            return 0.
+        return np.sqrt(float(self.sumsq) / self.n) * self.step_scale
+
+
+    def min(self):
+        if not self.mins:
+            return 0.
+        return self.mins[0][1] * self.step_scale
+
+
+    def max(self):
+        if not self.maxs:
+            return 0.
+        return self.maxs[0][1] * self.step_scale
+
+
+    def percentile(self, q):
+        # q in [0, 100], to the resolution of one step
+        if self.n == 0:
+            return 0.
+        i = np.searchsorted(np.cumsum(self.hist), q / 100. * self.n)
+        return (min(i, 2 * self.fe_max) - self.fe_max) * self.step_scale
+
+
+    def __repr__(self):
+        return 'min,avg,rms,max {0:.4f} {1:.4f} {2:.4f} {3:.4f}'.format(self.min(), self.mean(), self.rms(), self.max())
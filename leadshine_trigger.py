@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Oscilloscope-style trigger on the following-error of all axes
+#
+# Every block of every axis is kept for pre_sec + post_sec seconds. When the error of an axis
+# crosses level on the chosen edge, the trigger fires; once every axis has been sampled post_sec
+# past the trigger, the pre_sec before and post_sec after it are written to a snapshot file. All
+# times are time.time() of the host, so the axes line up in the snapshot. Further crossings are
+# ignored for holdoff_sec after the trigger, and until every axis holds pre_sec of history.
+#
+# Snapshot, prefix-YYYYmmdd-HHMMSS.mmm.npz:
+#   t_trigger, axis, level, edge   the trigger
+#   pre_span                       seconds before the trigger held by every axis, pre_sec unless an axis stopped
+#   parameters                     json, axis -> register name -> value, plus step_scale and fe_max
+#   <axis>.t, <axis>.error         samples of each axis, seconds and mm
+
+
+import collections
+import json
+import sys
+import time
+
+import numpy as np
+
+
+class Trigger:
+    def __init__(self, drives, prefix, level, edge='rising', absolute=True, pre_sec=1., post_sec=1., holdoff_sec=10., source=None):
+        # drives maps names to drives, their parameters are saved with each snapshot
+        self.drives = drives
+        self.prefix = prefix
+
+        # crossing of level, in mm, on a 'rising', 'falling', or 'either' edge
+        # with absolute, the magnitude of the error is compared, so an excursion of either sign is a rising edge
+        self.level = level
+        self.edge = edge
+        self.absolute = absolute
+        # the axis to trigger on, None for any
+        self.source = source
+
+        self.pre_sec = pre_sec
+        self.post_sec = post_sec
+        self.holdoff_sec = holdoff_sec
+
+        # axis -> deque of (error_x, error) blocks, bounded to pre_sec + post_sec
+        self.history = dict((k, collections.deque()) for k in drives)
+        # axis -> whether the last sample was above level
+        self.above = {}
+
+        # time and axis of the trigger awaiting its post_sec, or None
+        self.t_trigger = None
+        self.axis = None
+        self.t_holdoff = 0.
+
+        self.snapshots = []
+
+
+    def add_block(self, k, error, error_x):
+        error_x = np.asarray(error_x)
+        error = np.asarray(error, dtype=np.float32)
+
+        h = self.history[k]
+        h.append((error_x, error))
+        while len(h) > 1 and h[1][0][0] < error_x[-1] - self.pre_sec - self.post_sec:
+            h.popleft()
+
+        if self.t_trigger is None and (self.source is None or self.source == k):
+            i = self.crossing(k, error)
+            if i is not None and error_x[i] >= self.t_holdoff and self.armed(error_x[i]):
+                self.t_trigger = error_x[i]
+                self.axis = k
+                self.t_holdoff = self.t_trigger + self.holdoff_sec
+                print 'Trigger:', k, error[i], 'mm at', time.ctime(self.t_trigger)
+        else:
+            self.crossing(k, error)
+
+        if self.t_trigger is not None:
+            t_end = self.t_trigger + self.post_sec
+            # do not wait on an axis that has stopped delivering blocks
+            if all(len(v) == 0 or v[-1][0][-1] >= t_end for v in self.history.values()) or time.time() > t_end + 2 * self.post_sec + 1.:
+                self.snapshots += [self.write()]
+                self.t_trigger = None
+
+
+    def armed(self, t):
+        # whether every axis has samples from pre_sec before t, so a snapshot of a trigger at t is complete
+        return all(h and h[0][0][0] <= t - self.pre_sec for h in self.history.values())
+
+
+    def crossing(self, k, error):
+        # index of the first crossing of level in the block, or None
+        x = np.abs(error) if self.absolute else error
+        above = x >= self.level
+        prev = np.empty_like(above)
+        prev[0] = self.above.get(k, above[0])
+        prev[1:] = above[:-1]
+        self.above[k] = above[-1]
+
+        if self.edge == 'rising':
+            edges = above & ~prev
+        elif self.edge == 'falling':
+            edges = ~above & prev
+        else:
+            edges = above != prev
+
+        i = np.flatnonzero(edges)
+        return i[0] if len(i) else None
+
+
+    def write(self):
+        t0 = self.t_trigger - self.pre_sec
+        t1 = self.t_trigger + self.post_sec
+
+        arrays = {}
+        pre_span = self.pre_sec
+        for k, h in self.history.items():
+            if h:
+                t = np.concatenate([v[0] for v in h])
+                e = np.concatenate([v[1] for v in h])
+            else:
+                t = np.zeros(0)
+                e = np.zeros(0, dtype=np.float32)
+            m = (t >= t0) & (t <= t1)
+            arrays[k + '.t'] = t[m]
+            arrays[k + '.error'] = e[m]
+            # from the start of the history, a blind gap between blocks does not shorten the span
+            pre_span = min(pre_span, self.t_trigger - t[0] if len(t) else 0.)
+
+        parameters = {}
+        for k, es in self.drives.items():
+            p = dict(getattr(es, 'parameters', {}))
+            p['step_scale'] = es.step_scale
+            p['fe_max'] = es.fe_max
+            parameters[k] = p
+
+        fn = '{0}-{1}.{2:03d}.npz'.format(self.prefix, time.strftime('%Y%m%d-%H%M%S', time.localtime(self.t_trigger)), int(self.t_trigger % 1 * 1000))
+        np.savez_compressed(fn, t_trigger=self.t_trigger, axis=self.axis, level=self.level, edge=self.edge, pre_span=pre_span,
+                            parameters=json.dumps(parameters, sort_keys=True), **arrays)
+        if pre_span < self.pre_sec:
+            print 'Trigger: only', pre_span, 's before the trigger in', fn
+        print 'Trigger: wrote', fn
+
+        return fn
+
+
+def load(fn):
+    # the trigger, the parameters, and axis -> (t, error) of a snapshot, t is relative to the trigger
+    d = np.load(fn)
+    t_trigger = float(d['t_trigger'])
+    axes = sorted(k[:-2] for k in d.files if k.endswith('.t'))
+    rv = dict((k, (d[k + '.t'] - t_trigger, d[k + '.error'])) for k in axes)
+    return t_trigger, str(d['axis']), json.loads(str(d['parameters'])), rv
+
+
+def view(fn):
+    import matplotlib.pyplot as plt
+
+    t_trigger, axis, parameters, rv = load(fn)
+
+    for k, (t, e) in sorted(rv.items()):
+        plt.plot(t, e, label=k)
+    plt.axvline(0., color='k', linestyle=':')
+    plt.title('{0} triggered at {1}'.format(axis, time.ctime(t_trigger)))
+    plt.xlabel('Time relative to trigger (sec)')
+    plt.ylabel('Following-error (mm)')
+    plt.legend()
+    plt.show()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print 'usage:', sys.argv[0], 'snapshot.npz'
+        sys.exit(1)
+
+    view(sys.argv[1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+#
+# MIT License
+#
+# Copyright (c) 2016, 2017 Kent A. Vander Velden
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Kent A. Vander Velden
+# kent.vandervelden@gmail.com
+
+
+
+# Gain sweep of the position loop
+#
+# Each candidate set of gains is written to the drive, the motion test is run, and the captured
+# following-error is scored. Axes are on their own serial ports and are swept at the same time.
+# Every result is appended to a table as soon as it is known, so an interrupted sweep resumes
+# where it left off, candidates already in the table are not run again.
+
+
+import csv
+import itertools
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from leadshine_easyservo import *
+
+
+serial_ports = {'x-axis': '/dev/ttyUSB0',
+                'y-axis': '/dev/ttyUSB1',
+                'z-axis': '/dev/ttyUSB2'}
+
+gain_names = ['position loop kp', 'position loop ki', 'position loop kd', 'position loop kvff']
+
+# 'grid' tests every combination of sweep_grid, 'adaptive' is a coordinate search starting from the current gains
+search = 'grid'
+
+sweep_grid = {'position loop kp':   [1500, 2000, 2500, 3000],
+              'position loop ki':   [300, 500, 700],
+              'position loop kd':   [100, 200, 300],
+              'position loop kvff': [20, 30, 40]}
+
+# metric to minimize, one of 'rms', 'peak', or 'settling'
+objective = 'rms'
+
+# following-error within this band is considered settled (mm)
+settle_band = .01
+
+results_fn = 'gain_sweep.csv'
+
+
+def error_metrics(error, dt, band=settle_band):
+    # error is one capture, or a 2-D array with one capture per row, dt is the sample period
+    # returns the rms, the peak, and the settling time, i.e. the time of the last sample outside of the band
+    e = np.abs(np.asarray(error, dtype=float))
+    n = e.shape[-1]
+
+    rms = np.sqrt(np.mean(e ** 2, axis=-1))
+    peak = np.max(e, axis=-1)
+
+    outside = e > band
+    last = n - np.argmax(outside[..., ::-1], axis=-1)
+    settling = np.where(outside.any(axis=-1), last, 0) * dt
+
+    return rms, peak, settling
+
+
+class ResultsTable:
+    fields = ['axis'] + gain_names + ['rms', 'peak', 'settling', 'time']
+
+    def __init__(self, fn):
+        self.fn = fn
+        # the sweeps of all axes append to the same table
+        self.lock = threading.Lock()
+
+
+    def load(self, axis):
+        # previous results of an axis, keyed by the tuple of gains
+        rv = {}
+        if not os.path.exists(self.fn):
+            return rv
+
+        with open(self.fn, 'rb') as f:
+            for row in csv.DictReader(f):
+                if row['axis'] != axis:
+                    continue
+                key = tuple(int(row[k]) for k in gain_names)
+                rv[key] = dict((k, float(row[k])) for k in ['rms', 'peak', 'settling'])
+
+        return rv
+
+
+    def append(self, axis, gains, score):
+        row = dict(gains)
+        row.update(score)
+        row['axis'] = axis
+        row['time'] = time.time()
+
+        with self.lock:
+            new_file = not os.path.exists(self.fn)
+            with open(self.fn, 'ab') as f:
+                w = csv.DictWriter(f, ResultsTable.fields)
+                if new_file:
+                    w.writeheader()
+                w.writerow(row)
+
+
+class GainSweep:
+    def __init__(self, axis, drive, results):
+        self.axis = axis
+        self.drive = drive
+        self.results = results
+        self.done = results.load(axis)
+        self.n_run = 0
+
+
+    def evaluate(self, gains):
+        key = tuple(gains[k] for k in gain_names)
+        if key in self.done:
+            return self.done[key]
+
+        if not self.drive.write_parameters(gains, verify=True):
+            print 'evaluate(): failed to write gains', self.axis, gains
+            return None
+
+        error, error_x = self.drive.motion_test()
+        if error == []:
+            print 'evaluate(): motion test failed', self.axis, gains
+            return None
+        self.n_run += 1
+
+        dt = self.drive.scope_duration / len(error)
+        rms, peak, settling = error_metrics(error, dt)
+        score = {'rms': float(rms), 'peak': float(peak), 'settling': float(settling)}
+        print self.axis, key, 'rms: {0:.4f} peak: {1:.4f} settling: {2:.3f}'.format(rms, peak, settling)
+
+        self.done[key] = score
+        self.results.append(self.axis, gains, score)
+        return score
+
+
+    def grid(self, grid):
+        for values in itertools.product(*[grid[k] for k in gain_names]):
+            self.evaluate(dict(zip(gain_names, values)))
+
+
+    def adaptive(self, start, step=.25, min_step=.02, max_evals=60):
+        # coordinate search, each gain in turn is scaled by (1 +/- step), keeping any improvement
+        # step is halved whenever no gain improves
+        current = dict(start)
+        best = self.evaluate(current)
+        if best is None:
+            return
+
+        n = 0
+        while step >= min_step and n < max_evals:
+            improved = False
+            for k in gain_names:
+                for sign in [1, -1]:
+                    lo, hi = register_map[k].rng
+                    v = min(max(int(round(current[k] * (1 + sign * step))), lo), hi)
+                    if v == current[k]:
+                        continue
+
+                    candidate = dict(current)
+                    candidate[k] = v
+                    score = self.evaluate(candidate)
+                    n += 1
+                    if score is not None and score[objective] < best[objective]:
+                        current, best, improved = candidate, score, True
+                        break
+
+            if not improved:
+                step /= 2.
+
+
+    def best(self):
+        if not self.done:
+            return None, None
+        key = min(self.done, key=lambda k: self.done[k][objective])
+        return dict(zip(gain_names, key)), self.done[key]
+
+
+    def run(self):
+        original = dict((k, self.drive.parameters[k]) for k in gain_names)
+
+        if search == 'grid':
+            self.grid(sweep_grid)
+        elif search == 'adaptive':
+            self.adaptive(original)
+        else:
+            print 'run(): unknown search', search
+
+        # leave the drive as it was found, the best gains are reported and not applied
+        self.drive.write_parameters(original, verify=True)
+
+        return self.best()
+
+
+def main():
+    ess = open_drives(serial_ports)
+
+    results = ResultsTable(results_fn)
+    sweeps = dict((k, GainSweep(k, es, results)) for k, es in ess.items())
+
+    st = time.time()
+    best = for_each_drive(sweeps, lambda sw: sw.run())
+
+    print
+    print 'Sweep completed in {0:.1f} s'.format(time.time() - st)
+    for k in sorted(best):
+        gains, score = best[k]
+        print k, 'new runs:', sweeps[k].n_run, 'best:', gains, score
+
+
+if __name__ == "__main__":
+    main()
@@ -49,12 +49,17 @@ except AttributeError:
 
 from timing import *
 from leadshine_easyservo import *
+from leadshine_acquire import *
+from leadshine_server import LeadshineClient
 
 
 serial_ports = {#'x-axis': '/dev/ttyUSB0',
                 #'y-axis': '/dev/ttyUSB1',
                 'z-axis': '/dev/ttyUSB2'}
 
+# subscribe to a leadshine_server rather than opening the serial ports, e.g. ('localhost', 5555)
+server_address = None
+
 # retain only the last X seconds of data for graph
 last_x_sec = 5
 
@@ -195,20 +200,17 @@ def main():
     cnc_c.mode(linuxcnc.MODE_MDI)
     cnc_c.wait_complete()
 
-    ess = {}
-    for k,v in serial_ports.items():
-        es = LeadshineEasyServo()
-        es.open_serial(v)
-
-        if not es.send_introduction():
-            print 'main(): failed introduction', k
-            sys.exit(1)
+    if server_address is None:
+        # all drives are brought up at once
+        drives = open_drives(serial_ports)
+    else:
+        client = LeadshineClient(server_address)
+        drives = client.drives()
 
+    ess = {}
+    for k,es in drives.items():
         ess[k] = {'drive': es, 'plot': None}
 
-    for k,es in ess.items():
-        es['drive'].read_parameters()
-
     if True:
         cummul_error = {}
         cummul_error_x = {}
@@ -222,8 +224,11 @@ def main():
             cummul_error[k] = []
             cummul_error_x[k] = []
 
-        for k,es in ess.items():
-            es['drive'].scope_exec('begin')
+        if server_address is None:
+            acq = Acquisition(drives)
+        else:
+            acq = client
+        acq.start()
 
         add_values = True
         x_z_diff = []
@@ -240,60 +245,56 @@ def main():
         line1 = None
 
         while True:
-            for k,es in ess.items():
-                time.sleep(.001)
-                error, error_x = es['drive'].scope_exec('retrieve')
-                if error != []:
-                    cummul_error[k] += error
-                    cummul_error_x[k] += error_x
-
-                    # start next request while finishing up with the latest data
-                    es['drive'].scope_exec('begin')
-
-                    # remove data from the front of the buffers until only the last_x seconds remain
-                    # XXX this is the last_x seconds received vs. what was received within the last_x seconds
-                    # if no additional data is received, the array is not cleared out
-                    while cummul_error_x[k][-1] - cummul_error_x[k][0] > last_x_sec:
-                        cummul_error[k] = cummul_error[k][100:]
-                        cummul_error_x[k] = cummul_error_x[k][100:]
-
-                    # overlap the sampling with the updating of the graph
-                    t4.start()
-                    es['plot'].plot_error(cummul_error[k], cummul_error_x[k])
-                    t4.lap()
-
-                    #print k, cummul_error[k][:10], cummul_error_x[k][:10]
-
-                    cnc_s.poll()
-                    machine_pos = cnc_s.position[:3]
-                    err = es['drive'].fe_max * es['drive'].step_scale
-                    print(error, machine_pos)
-
-                    if add_values:
-                        x_z_diff += [abs(machine_pos[-1] - z_start) * 25.4]
-                        y_err += [error[-1]]
-
-                    if error[-1] > 1.:
-                    #if error[-1] > .5:
-                    #if error[-1] > .1:
-                    #if error[-1] > .05:
-                    #if error[-1] > 0:
-                        print('STOP!')
-                        add_values = False
-                    else:
-                        move_to(machine_pos[0], machine_pos[1], machine_pos[2]-.01, feedrate=5)
-
-                    if line1 is None:
-                        line1, = ax.plot(x_z_diff, y_err)
-                        plt.ion()
-                        plt.show()
-                    else:
-                        print('x:', x_z_diff, 'y:', y_err)
-                        line1.set_data(x_z_diff, y_err)
-                        ax.relim()
-                        ax.autoscale_view(True,True,True)
-                        fig.canvas.draw()
-                        fig.canvas.flush_events()
+            # the next request of the drive has begun, so the sampling overlaps with the rest of the loop
+            k, error, error_x = acq.next_block()
+            es = ess[k]
+            cummul_error[k] += error
+            cummul_error_x[k] += error_x
+
+            # remove data from the front of the buffers until only the last_x seconds remain
+            # XXX this is the last_x seconds received vs. what was received within the last_x seconds
+            # if no additional data is received, the array is not cleared out
+            while cummul_error_x[k][-1] - cummul_error_x[k][0] > last_x_sec:
+                cummul_error[k] = cummul_error[k][100:]
+                cummul_error_x[k] = cummul_error_x[k][100:]
+
+            # overlap the sampling with the updating of the graph
+            t4.start()
+            es['plot'].plot_error(cummul_error[k], cummul_error_x[k])
+            t4.lap()
+
+            #print k, cummul_error[k][:10], cummul_error_x[k][:10]
+
+            cnc_s.poll()
+            machine_pos = cnc_s.position[:3]
+            err = es['drive'].fe_max * es['drive'].step_scale
+            print(error, machine_pos)
+
+            if add_values:
+                x_z_diff += [abs(machine_pos[-1] - z_start) * 25.4]
+                y_err += [error[-1]]
+
+            if error[-1] > 1.:
+            #if error[-1] > .5:
+            #if error[-1] > .1:
+            #if error[-1] > .05:
+            #if error[-1] > 0:
+                print('STOP!')
+                add_values = False
+            else:
+                move_to(machine_pos[0], machine_pos[1], machine_pos[2]-.01, feedrate=5)
+
+            if line1 is None:
+                line1, = ax.plot(x_z_diff, y_err)
+                plt.ion()
+                plt.show()
+            else:
+                print('x:', x_z_diff, 'y:', y_err)
+                line1.set_data(x_z_diff, y_err)
+                ax.relim()
+                ax.autoscale_view(True,True,True)
+                fig.canvas.draw()
+                fig.canvas.flush_events()
 
 
 